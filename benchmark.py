@@ -0,0 +1,274 @@
+# Benchmark & load test offline: Discord, yt-dlp, Spotify, dan ffmpeg semuanya diganti tiruan.
+# Contoh: python benchmark.py --guilds 300 --extract-latency 0.4 --fail-ttfa-p95 8
+import os
+import sys
+import io
+import json
+import time
+import random
+import asyncio
+import argparse
+import threading
+import contextlib
+
+# Harus diset sebelum bot diimpor: tanpa SQLite, tanpa endpoint metrik, ekstraksi di thread (stub tidak bisa di-pickle ke proses)
+os.environ.setdefault('DISCORD_BOT_TOKEN', 'benchmark')
+os.environ.setdefault('SPOTIPY_CLIENT_ID', 'benchmark'); os.environ.setdefault('SPOTIPY_CLIENT_SECRET', 'benchmark')
+os.environ.update({'STATE_DB_PATH': '', 'METRICS_PORT': '0', 'EXTRACT_POOL_MODE': 'thread', 'PLAYBACK_ENGINE': 'pcm', 'AUDIO_CACHE_ENABLED': '0'})
+
+import discord
+import bot as B
+
+FRAME = b'\0' * 3840 # 20 ms PCM stereo 48 kHz
+
+# --- Tiruan Layanan Eksternal ---
+class FakeYoutubeDL:
+    latency = 0.3; jitter = 0.5; track_seconds = 4.0
+
+    def __init__(self, opts=None): self.opts = opts or {}
+    def __enter__(self): return self
+    def __exit__(self, *exc): return False
+
+    def extract_info(self, query, download=False):
+        time.sleep(self.latency * random.uniform(1 - self.jitter, 1 + self.jitter)) # Berjalan di thread pool ekstraksi, sama seperti yt-dlp asli
+        vid = format(abs(hash(query)) % 16**11, '011x')
+        entry = {'id': vid, 'title': f"Video {query}"[:90], 'webpage_url': f"https://www.youtube.com/watch?v={vid}", 'duration': self.track_seconds, 'uploader': 'Benchmark',
+                 'thumbnail': None, 'url': f"https://rr1.googlevideo.com/videoplayback?id={vid}&expire={int(time.time()) + 21600}", 'acodec': 'opus', 'ext': 'webm'}
+        return entry if query.startswith('http') else {'entries': [entry]}
+
+    def prepare_filename(self, data): return f"downloads/{data['id']}.webm"
+
+class FakeSpotify:
+    latency = 0.1; playlist_size = 500
+
+    def _wait(self): time.sleep(self.latency)
+
+    def _track(self, n): return {'name': f"Lagu {n}", 'artists': [{'name': f"Artis {n % 97}"}], 'external_urls': {'spotify': f"https://open.spotify.com/track/{n:022d}"}, 'album': {'images': [{'url': f"https://i.scdn.co/image/{n % 50}"}]}}
+    def track(self, track_id): self._wait(); return self._track(int(track_id[-6:], 36) % 10**6)
+    def playlist(self, playlist_id, fields=None): self._wait(); return {'name': f"Playlist {playlist_id}", 'images': [{'url': 'https://i.scdn.co/image/cover'}]}
+
+    def playlist_items(self, playlist_id, fields=None, limit=100, offset=0):
+        self._wait()
+        return {'items': [{'track': self._track(n)} for n in range(offset, min(offset + limit, self.playlist_size))], 'total': self.playlist_size, 'next': None}
+
+class FakeFFmpeg(discord.AudioSource):
+    def __init__(self, *args, **kwargs): self.frames = int(FakeYoutubeDL.track_seconds * 50)
+    def read(self):
+        if self.frames <= 0: return b''
+        self.frames -= 1; return FRAME
+    def is_opus(self): return False
+    def cleanup(self): self.frames = 0
+
+# --- Tiruan Discord ---
+class FakeMessage:
+    _next_id = 0
+    def __init__(self, channel, **fields):
+        FakeMessage._next_id += 1; self.id = FakeMessage._next_id; self.channel = channel; self.view = fields.get('view'); self.created_at = discord.utils.utcnow()
+    async def edit(self, **fields): self.view = fields.get('view', self.view); self.channel.edits += 1; return self
+    async def delete(self): pass
+
+class FakeTextChannel:
+    def __init__(self, channel_id): self.id = channel_id; self.sent = 0; self.edits = 0; self.last_message_id = None
+    async def send(self, content=None, **fields):
+        message = FakeMessage(self, **fields); self.sent += 1; self.last_message_id = message.id; return message
+
+class FakeVoiceClient:
+    def __init__(self, guild, channel): self.guild = guild; self.channel = channel; self.source = None; self._after = None; self._paused = False
+    def is_connected(self): return True
+    def is_playing(self): return self.source is not None and not self._paused
+    def is_paused(self): return self.source is not None and self._paused
+    def play(self, source, *, after=None):
+        if self.source is not None: raise discord.ClientException('Already playing audio.')
+        self._after = after; self.source = source; mixer.attach(self)
+    def _finish(self):
+        source, after = self.source, self._after
+        self.source = self._after = None
+        if source is None: return
+        mixer.track_ended(self.guild.id)
+        if after: after(None)
+        source.cleanup()
+    def stop(self): self._finish()
+    def pause(self): self._paused = True
+    def resume(self): self._paused = False
+    async def disconnect(self, *, force=False): self._finish(); mixer.detach(self); self.guild.voice_client = None
+
+class FakeVoiceChannel:
+    def __init__(self, guild): self.guild = guild; self.id = guild.id * 10; self.name = 'benchmark-vc'; self.members = []
+    async def connect(self): self.guild.voice_client = FakeVoiceClient(self.guild, self); return self.guild.voice_client
+
+class FakeGuild:
+    def __init__(self, guild_id): self.id = guild_id; self.voice_client = None; self.shard_id = 0; self.me = None
+
+class FakeMember:
+    def __init__(self, voice_channel): self.id = 1; self.mention = '@benchmark'; self.bot = False; self.voice = type('VoiceState', (), {'channel': voice_channel})()
+
+class Typing:
+    async def __aenter__(self): return self
+    async def __aexit__(self, *exc): return False
+
+class FakeContext:
+    def __init__(self, guild, channel, author, command):
+        self.guild = guild; self.channel = channel; self.author = author; self.command = command; self.prefix = B.BOT_PREFIX
+        self.message = FakeMessage(channel); self.invoked_with = command.name
+    @property
+    def voice_client(self): return self.guild.voice_client
+    async def send(self, *args, **kwargs): return await self.channel.send(*args, **kwargs)
+    def typing(self): return Typing()
+
+# --- Mixer: pengganti thread audio discord.py (satu thread, tick 20 ms untuk semua voice client) ---
+class Mixer(threading.Thread):
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.clients = set(); self.lock = threading.Lock(); self.running = True
+        self.first_audio = {} # guild_id -> waktu frame pertama yang pernah dibaca
+        self.ended_at = {} # guild_id -> waktu lagu terakhir selesai/di-skip
+        self.gaps = []; self.transitions = {}; self.last_source = {}
+
+    def attach(self, vc):
+        with self.lock: self.clients.add(vc)
+    def detach(self, vc):
+        with self.lock: self.clients.discard(vc)
+    def track_ended(self, guild_id): self.ended_at[guild_id] = time.perf_counter()
+
+    def run(self):
+        next_tick = time.perf_counter()
+        while self.running:
+            with self.lock: clients = list(self.clients)
+            for vc in clients:
+                source = vc.source
+                if source is None or vc._paused: continue
+                data = source.read(); now = time.perf_counter(); guild_id = vc.guild.id
+                if not data: vc._finish(); continue
+                track = getattr(source, 'track', source) # Mode gapless: lagu berganti di dalam pembungkus, tanpa vc.play baru
+                if self.last_source.get(guild_id) is not track:
+                    handoff = guild_id in self.last_source and guild_id not in self.ended_at
+                    self.last_source[guild_id] = track; self.first_audio.setdefault(guild_id, now)
+                    ended = now if handoff else self.ended_at.pop(guild_id, None)
+                    if ended is not None: self.gaps.append(now - ended); self.transitions[guild_id] = self.transitions.get(guild_id, 0) + 1
+            next_tick += 0.02
+            time.sleep(max(0.0, next_tick - time.perf_counter()))
+
+mixer = Mixer()
+
+# --- Skenario per Guild ---
+async def invoke(command, guild, channel, author, **kwargs):
+    ctx = FakeContext(guild, channel, author, command)
+    await B.mark_command_start(ctx); await command.callback(ctx, **kwargs); await B.record_command_time(ctx)
+
+async def wait_until(predicate, timeout):
+    deadline = time.perf_counter() + timeout
+    while not predicate() and time.perf_counter() < deadline: await asyncio.sleep(0.05)
+    return predicate()
+
+async def run_guild(index, args, results):
+    guild = FakeGuild(10_000 + index); channel = FakeTextChannel(guild.id); author = FakeMember(FakeVoiceChannel(guild))
+    await asyncio.sleep(random.uniform(0, args.ramp))
+    started = time.perf_counter()
+    from_spotify = index < args.guilds * args.spotify_ratio
+    first_query = f"https://open.spotify.com/playlist/bench{index:06d}" if from_spotify else f"lagu {index}-0"
+    await invoke(B.play, guild, channel, author, query=first_query)
+    for n in range(1, args.tracks): await invoke(B.play, guild, channel, author, query=f"lagu {index}-{n}")
+    await invoke(B.queue_command, guild, channel, author)
+    if await wait_until(lambda: guild.id in mixer.first_audio, args.timeout): results['ttfa'].append(mixer.first_audio[guild.id] - started)
+    else: results['timeouts'] += 1; return
+    for _ in range(args.skips):
+        await asyncio.sleep(args.skip_interval); await invoke(B.skip, guild, channel, author)
+    total_tracks = args.tracks - 1 + (args.playlist_size if from_spotify else 1)
+    target = min(args.skips + args.transitions, total_tracks - 1) # Tidak menunggu transisi yang lagunya memang tidak ada
+    if not await wait_until(lambda: mixer.transitions.get(guild.id, 0) >= target, args.timeout): results['timeouts'] += 1
+    queue = B.find_queue(guild.id)
+    if queue: results['queue_bytes'].append(queue.memory_usage()); results['queue_items'].append(len(queue))
+    results['messages'] += channel.sent; results['edits'] += channel.edits
+    await invoke(B.stop, guild, channel, author)
+
+# --- Laporan ---
+def percentile(samples, q):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(q * len(samples)))] if samples else 0.0
+
+def summarize(samples):
+    return {'n': len(samples), 'p50': round(percentile(samples, 0.5), 4), 'p95': round(percentile(samples, 0.95), 4), 'p99': round(percentile(samples, 0.99), 4), 'max': round(max(samples, default=0.0), 4)}
+
+def rss_bytes():
+    try:
+        with open('/proc/self/statm') as statm: return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError): return 0
+
+async def main(args):
+    random.seed(args.seed)
+    FakeYoutubeDL.latency = args.extract_latency; FakeYoutubeDL.track_seconds = args.track_seconds
+    FakeSpotify.latency = args.spotify_latency; FakeSpotify.playlist_size = args.playlist_size
+    B._youtube_dl = type('FakeYtDlpModule', (), {'YoutubeDL': FakeYoutubeDL}); discord.FFmpegPCMAudio = FakeFFmpeg # yt_dlp asli tidak pernah dimuat
+    B.sp = FakeSpotify(); B.spotify_api = B.SpotifyAsync(B.sp, B.SPOTIFY_MAX_CONCURRENCY)
+    B.GAPLESS_ENABLED = args.gapless; B.GAPLESS_CROSSFADE = args.crossfade
+    B.bot.loop = asyncio.get_running_loop()
+    B.metrics.sampler = B.spawn_task(B.metrics.sample_loop_lag())
+    mixer.start()
+
+    results = {'ttfa': [], 'queue_bytes': [], 'queue_items': [], 'timeouts': 0, 'errors': 0, 'messages': 0, 'edits': 0}
+    rss_before = rss_bytes(); started = time.perf_counter()
+    bot_output = io.StringIO()
+    with contextlib.redirect_stdout(sys.stdout if args.verbose else bot_output):
+        outcomes = await asyncio.gather(*(run_guild(i, args, results) for i in range(args.guilds)), return_exceptions=True)
+    for outcome in outcomes:
+        if isinstance(outcome, BaseException): results['errors'] += 1; print(f"Guild gagal: {type(outcome).__name__}: {outcome}")
+    elapsed = time.perf_counter() - started; rss_after = rss_bytes(); mixer.running = False
+
+    stages = {name: {'n': hist.count, 'p50': round(hist.quantile(0.5), 4), 'p95': round(hist.quantile(0.95), 4)} for name, hist in sorted(B.metrics.stages.items())}
+    report = {
+        'config': {k: v for k, v in vars(args).items() if k != 'json'}, 'elapsed': round(elapsed, 2),
+        'time_to_first_audio': summarize(results['ttfa']), 'transition_gap': summarize(mixer.gaps),
+        'loop_lag': {'p50': round(B.metrics.loop_lag.quantile(0.5), 4), 'p95': round(B.metrics.loop_lag.quantile(0.95), 4), 'max': round(B.metrics.loop_lag_max, 4)},
+        'memory': {'rss_delta_per_guild': (rss_after - rss_before) // max(1, args.guilds), 'queue_bytes_per_guild': sum(results['queue_bytes']) // max(1, len(results['queue_bytes'])),
+                   'queue_items_per_guild': sum(results['queue_items']) // max(1, len(results['queue_items']))},
+        'messages': {'sent': results['messages'], 'edits': results['edits'], **B.message_updates.stats()},
+        'gapless': dict(B.gapless_stats), 'extraction': B.extraction_pool.stats(), 'resolve_cache': B.resolve_cache.stats(), 'stages': stages,
+        'timeouts': results['timeouts'], 'errors': results['errors'],
+    }
+    return report
+
+def print_report(report):
+    print(f"== Benchmark: {report['config']['guilds']} guild, {report['elapsed']}s ==")
+    for key, title in (('time_to_first_audio', 'Time-to-first-audio'), ('transition_gap', 'Jeda transisi')):
+        s = report[key]; print(f"{title:<22} n={s['n']:<5} p50={s['p50']*1000:8.1f}ms p95={s['p95']*1000:8.1f}ms p99={s['p99']*1000:8.1f}ms max={s['max']*1000:8.1f}ms")
+    lag = report['loop_lag']; print(f"{'Lag event loop':<22} p50={lag['p50']*1000:.1f}ms p95={lag['p95']*1000:.1f}ms max={lag['max']*1000:.1f}ms")
+    mem = report['memory']; print(f"{'Memori per guild':<22} RSS +{mem['rss_delta_per_guild']/1024:.1f} KiB, antrian {mem['queue_bytes_per_guild']/1024:.1f} KiB ({mem['queue_items_per_guild']} item)")
+    msg = report['messages']; print(f"{'Pesan':<22} {msg['sent']} kirim, {msg['edits']} edit, {msg['merged']} digabung, {msg['in_place']} in-place")
+    if report['config']['gapless']: print(f"{'Gapless':<22} {report['gapless']['handoffs']} tersambung, {report['gapless']['prepared']} disiapkan, {report['gapless']['dropped']} dibuang, {report['gapless']['failed']} gagal")
+    print("Tahap:")
+    for name, s in report['stages'].items(): print(f"  {name:<20} n={s['n']:<6} p50={s['p50']*1000:8.1f}ms p95={s['p95']*1000:8.1f}ms")
+    if report['timeouts'] or report['errors']: print(f"PERINGATAN: {report['timeouts']} timeout, {report['errors']} error")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark offline bot musik (Discord, yt-dlp, Spotify & ffmpeg ditiru).')
+    parser.add_argument('--guilds', type=int, default=200, help='Jumlah guild yang disimulasikan bersamaan')
+    parser.add_argument('--tracks', type=int, default=5, help='Perintah play per guild')
+    parser.add_argument('--skips', type=int, default=2, help='Skip per guild setelah audio mulai')
+    parser.add_argument('--skip-interval', type=float, default=0.5, help='Detik antar skip')
+    parser.add_argument('--transitions', type=int, default=1, help='Transisi alami (lagu habis) yang ditunggu per guild')
+    parser.add_argument('--track-seconds', type=float, default=4.0, help='Durasi lagu tiruan')
+    parser.add_argument('--extract-latency', type=float, default=0.3, help='Latensi rata-rata extract_info (detik, jitter ±50%%)')
+    parser.add_argument('--spotify-latency', type=float, default=0.1, help='Latensi tiap panggilan Spotify (detik)')
+    parser.add_argument('--playlist-size', type=int, default=500, help='Jumlah lagu playlist Spotify tiruan')
+    parser.add_argument('--spotify-ratio', type=float, default=0.25, help='Porsi guild yang mulai dengan playlist Spotify')
+    parser.add_argument('--ramp', type=float, default=2.0, help='Sebaran waktu mulai guild (detik)')
+    parser.add_argument('--timeout', type=float, default=120.0, help='Batas tunggu per tahap per guild (detik)')
+    parser.add_argument('--gapless', action='store_true', help='Aktifkan mode gapless (lagu berikutnya disiapkan sebelum lagu habis)')
+    parser.add_argument('--crossfade', type=float, default=0.0, help='Detik crossfade pada mode gapless')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='Tulis laporan lengkap ke file JSON ini')
+    parser.add_argument('--verbose', action='store_true', help='Tampilkan log bot')
+    parser.add_argument('--fail-ttfa-p95', type=float, help='Exit 1 jika p95 time-to-first-audio (detik) melebihi nilai ini')
+    parser.add_argument('--fail-gap-p95', type=float, help='Exit 1 jika p95 jeda transisi (detik) melebihi nilai ini')
+    parser.add_argument('--fail-lag-p95', type=float, help='Exit 1 jika p95 lag event loop (detik) melebihi nilai ini')
+    args = parser.parse_args()
+
+    report = asyncio.run(main(args))
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as f: json.dump(report, f, indent=2)
+    failures = [name for name, limit, value in (('ttfa', args.fail_ttfa_p95, report['time_to_first_audio']['p95']), ('gap', args.fail_gap_p95, report['transition_gap']['p95']), ('lag', args.fail_lag_p95, report['loop_lag']['p95']))
+                if limit is not None and value > limit]
+    if failures or report['errors'] or report['timeouts']:
+        if failures: print(f"REGRESI: {', '.join(failures)} melewati batas.")
+        sys.exit(1)
@@ -1,12 +1,36 @@
+import time
+STARTUP_STARTED = time.perf_counter() # Titik nol laporan fase startup
 import discord
 from discord.ext import commands
-import yt_dlp as youtube_dl
 import asyncio
-import spotipy
-from spotipy.oauth2 import SpotifyClientCredentials
 import re
 import os
+import random
+import sys
+import json
+import glob
+import signal
+import subprocess
+import urllib.request
+import sqlite3
+import functools
+import bisect
+import weakref
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from collections import OrderedDict, deque
 from dotenv import load_dotenv
+import threading
+# yt_dlp & spotipy sengaja tidak diimpor di sini: dimuat saat pertama dipakai / di-warm-up setelah on_ready
+
+# --- Laporan Fase Startup ---
+startup_phases = OrderedDict() # nama fase -> detik
+
+def record_startup_phase(name, since):
+    now = time.perf_counter(); startup_phases[name] = round(now - since, 3)
+    return now
+
+startup_mark = record_startup_phase('import modul', STARTUP_STARTED)
 
 # --- Muat Environment Variables dari .env file ---
 load_dotenv()
@@ -17,6 +41,56 @@ SPOTIPY_CLIENT_ID = os.getenv('SPOTIPY_CLIENT_ID')
 SPOTIPY_CLIENT_SECRET = os.getenv('SPOTIPY_CLIENT_SECRET')
 BOT_PREFIX = '!!' 
 WATERMARK_TEXT = "Bot Music by @paatih" 
+PREFETCH_DEPTH = int(os.getenv('PREFETCH_DEPTH', '2')) # Jumlah lagu berikutnya yang di-resolve lebih awal (0 = nonaktif)
+PREFETCH_MAX_AGE = int(os.getenv('PREFETCH_MAX_AGE', '1800')) # Detik; hasil prefetch yang lebih tua dari ini di-resolve ulang
+RESOLVE_CACHE_SIZE = int(os.getenv('RESOLVE_CACHE_SIZE', '512')) # Maks entri cache hasil yt-dlp (0 = nonaktif)
+RESOLVE_CACHE_TTL = int(os.getenv('RESOLVE_CACHE_TTL', '3600')) # Detik; dipakai jika URL stream tidak punya parameter expire
+RESOLVE_CACHE_MARGIN = int(os.getenv('RESOLVE_CACHE_MARGIN', '600')) # Detik; entri dibuang sebelum URL stream benar-benar kedaluwarsa
+SPOTIFY_MAX_CONCURRENCY = int(os.getenv('SPOTIFY_MAX_CONCURRENCY', '4')) # Maks request Spotify paralel (di luar event loop)
+SPOTIFY_STREAMING_ENQUEUE = os.getenv('SPOTIFY_STREAMING_ENQUEUE', '1') == '1' # Playlist besar: putar halaman pertama dulu, sisanya dimuat di background
+PLAYBACK_ENGINE = os.getenv('PLAYBACK_ENGINE', 'pcm').lower() # 'pcm' (decode + volume di Python) atau 'opus' (Opus langsung/di-encode ffmpeg)
+PLAYBACK_VOLUME = float(os.getenv('PLAYBACK_VOLUME', '0.5'))
+OPUS_BITRATE = int(os.getenv('OPUS_BITRATE', '128')) # kbps, hanya untuk jalur 'opus' yang di-encode ffmpeg
+EXTRACT_WORKERS = int(os.getenv('EXTRACT_WORKERS', '4')) # Maks ekstraksi yt-dlp bersamaan
+EXTRACT_POOL_MODE = os.getenv('EXTRACT_POOL_MODE', 'thread').lower() # 'thread' atau 'process' (parsing yt-dlp di luar proses bot)
+AUDIO_CACHE_ENABLED = os.getenv('AUDIO_CACHE_ENABLED', '0') == '1' # Simpan lagu populer ke disk (Opus) dan putar dari sana
+AUDIO_CACHE_DIR = os.getenv('AUDIO_CACHE_DIR', 'downloads/cache')
+AUDIO_CACHE_MAX_BYTES = int(os.getenv('AUDIO_CACHE_MAX_BYTES', str(2 * 1024**3))) # Anggaran disk; lewat dari ini -> LRU dibuang
+AUDIO_CACHE_MIN_PLAYS = int(os.getenv('AUDIO_CACHE_MIN_PLAYS', '3')) # Lagu diunduh setelah diputar sebanyak ini
+SHARD_MODE = os.getenv('SHARD_MODE', 'none').lower() # 'none' (satu koneksi gateway) atau 'auto' (AutoShardedBot)
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', '0')) # Total shard; 0 = pakai rekomendasi Discord
+SHARD_IDS = [int(x) for x in os.getenv('SHARD_IDS', '').split(',') if x.strip()] # Shard milik proses ini (diisi launcher cluster)
+CLUSTER_PROCESSES = int(os.getenv('CLUSTER_PROCESSES', '1')) # >1: jalankan N proses, masing-masing memegang sebagian shard
+CLUSTER_ID = os.getenv('CLUSTER_ID')
+STATE_DB_PATH = os.getenv('STATE_DB_PATH', 'player_state.db') # SQLite untuk antrian & posisi lagu antar restart ('' = nonaktif)
+STATE_FLUSH_INTERVAL = float(os.getenv('STATE_FLUSH_INTERVAL', '5')) # Detik antar penulisan batch (write-behind)
+STREAM_RECOVERY_MAX = int(os.getenv('STREAM_RECOVERY_MAX', '3')) # Maks. percobaan lanjut-di-posisi per lagu saat ffmpeg berhenti lebih awal
+STREAM_RECOVERY_TAIL = float(os.getenv('STREAM_RECOVERY_TAIL', '5')) # Berhenti dalam N detik terakhir lagu dianggap selesai normal
+AUTOPLAY_BATCH = int(os.getenv('AUTOPLAY_BATCH', '25')) # Jumlah kandidat yang diambil sekaligus dari mix YouTube per seed
+AUTOPLAY_CACHE_SIZE = int(os.getenv('AUTOPLAY_CACHE_SIZE', '256')) # Jumlah seed yang kandidatnya disimpan (LRU, dibagi antar guild)
+AUTOPLAY_CACHE_TTL = int(os.getenv('AUTOPLAY_CACHE_TTL', '3600')) # Detik sebelum kandidat suatu seed diambil ulang
+AUTOPLAY_RECENT_WINDOW = int(os.getenv('AUTOPLAY_RECENT_WINDOW', '50')) # ID video terakhir per guild yang tidak boleh diulang autoplay
+CHANNEL_UPDATE_RATE = int(os.getenv('CHANNEL_UPDATE_RATE', '5')) # Maks. request pesan bot per channel per jendela (batas Discord: 5 per 5 detik)
+CHANNEL_UPDATE_PER = float(os.getenv('CHANNEL_UPDATE_PER', '5')) # Panjang jendela rate limit per channel (detik)
+STATE_AUTO_RESUME = os.getenv('STATE_AUTO_RESUME', '1') == '1' # Setelah restart, masuk lagi ke VC & lanjutkan lagu jika masih ada pendengar
+BREAKER_WINDOW = float(os.getenv('BREAKER_WINDOW', '60')) # Detik jendela geser untuk menghitung rasio gagal ekstraksi
+BREAKER_MIN_FAILURES = int(os.getenv('BREAKER_MIN_FAILURES', '5')) # Minimal kegagalan dalam jendela sebelum breaker bisa terbuka
+BREAKER_FAILURE_RATE = float(os.getenv('BREAKER_FAILURE_RATE', '0.5')) # Rasio gagal (0-1) yang membuka breaker
+BREAKER_BASE_BACKOFF = float(os.getenv('BREAKER_BASE_BACKOFF', '15')) # Backoff awal (detik), berlipat tiap trip beruntun, dengan jitter
+BREAKER_MAX_BACKOFF = float(os.getenv('BREAKER_MAX_BACKOFF', '600')) # Batas atas backoff (detik)
+BATCH_MAX_ENTRIES = int(os.getenv('BATCH_MAX_ENTRIES', '100')) # Maks. baris per perintah playbatch
+BATCH_RESOLVE_CONCURRENCY = int(os.getenv('BATCH_RESOLVE_CONCURRENCY', '4')) # Entri playbatch yang di-resolve bersamaan
+GAPLESS_ENABLED = os.getenv('GAPLESS_ENABLED', '0') == '1' # Siapkan ffmpeg lagu berikutnya sebelum lagu sekarang habis, lalu sambung tanpa jeda
+GAPLESS_LEAD = float(os.getenv('GAPLESS_LEAD', '10')) # Detik sebelum akhir lagu saat lagu berikutnya mulai disiapkan
+GAPLESS_BUFFER = float(os.getenv('GAPLESS_BUFFER', '2')) # Detik audio awal lagu berikutnya yang dibaca lebih dulu ke memori
+GAPLESS_CROSSFADE = float(os.getenv('GAPLESS_CROSSFADE', '0')) # Detik crossfade antar lagu (hanya engine 'pcm'); 0 = langsung sambung
+QUEUE_PAGE_SIZE = int(os.getenv('QUEUE_PAGE_SIZE', '10')) # Lagu per halaman tampilan antrian
+IDLE_TIMEOUT = float(os.getenv('IDLE_TIMEOUT', '300')) # Detik bot diam (tidak memutar/jeda) sebelum keluar VC; 0 = nonaktif
+EMPTY_CHANNEL_TIMEOUT = float(os.getenv('EMPTY_CHANNEL_TIMEOUT', '60')) # Detik VC tanpa pendengar sebelum bot keluar; 0 = nonaktif
+REAPER_INTERVAL = float(os.getenv('REAPER_INTERVAL', '15')) # Detik antar pemeriksaan reaper
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1') # Endpoint Prometheus hanya lokal secara default
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0')) # 0 = endpoint nonaktif; mode cluster: port + nomor cluster
+LOOP_LAG_INTERVAL = float(os.getenv('LOOP_LAG_INTERVAL', '0.5')) # Detik antar sampel lag event loop
 
 if not TOKEN:
     print("ERROR: DISCORD_BOT_TOKEN tidak ditemukan. Pastikan ada di file .env")
@@ -30,12 +104,219 @@ intents.message_content = True
 intents.guilds = True
 intents.voice_states = True
 
-# --- Global States for Music Bot ---
-music_queue = {} 
-current_song = {} 
-now_playing_message = {} 
-autoplay_enabled = {} 
-song_history = {} 
+# --- Metrik & Instrumentasi (murah, aman dinyalakan di produksi) ---
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class LatencyHistogram:
+    __slots__ = ('counts', 'total', 'count', 'recent')
+
+    def __init__(self):
+        self.counts = [0] * (len(METRIC_BUCKETS) + 1); self.total = 0.0; self.count = 0
+        self.recent = deque(maxlen=512) # Sampel terbaru untuk p50/p95 di !!stats
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(METRIC_BUCKETS, seconds)] += 1; self.total += seconds; self.count += 1; self.recent.append(seconds)
+
+    def quantile(self, q):
+        samples = sorted(self.recent)
+        return samples[min(len(samples) - 1, int(q * len(samples)))] if samples else 0.0
+
+class Metrics:
+    def __init__(self):
+        self.stages = {} # nama tahap -> LatencyHistogram
+        self.commands = {} # nama perintah -> jumlah pemanggilan
+        self.loop_lag = LatencyHistogram(); self.loop_lag_max = 0.0
+        self.sampler = self.server = None
+
+    def observe(self, stage, seconds):
+        # Juga dipanggil dari thread audio (paket pertama); cukup operasi sederhana di bawah GIL
+        hist = self.stages.get(stage)
+        if hist is None: hist = self.stages.setdefault(stage, LatencyHistogram())
+        hist.observe(seconds)
+
+    async def sample_loop_lag(self):
+        while True:
+            started = time.perf_counter(); await asyncio.sleep(LOOP_LAG_INTERVAL)
+            lag = max(0.0, time.perf_counter() - started - LOOP_LAG_INTERVAL)
+            self.loop_lag.observe(lag); self.loop_lag_max = max(self.loop_lag_max, lag)
+
+metrics = Metrics()
+
+# --- Antrian per Guild ---
+class QueuedTrack:
+    # Item antrian ringkas: tanpa __dict__, string artis/thumbnail di-intern agar dibagi ribuan entri playlist
+    __slots__ = ('title', 'artist', 'spotify_url', 'thumbnail', '_query', 'duration')
+
+    def __init__(self, title, artist='', spotify_url=None, thumbnail=None, query=None, duration=None):
+        self.title = title
+        self.artist = sys.intern(artist) if artist else ''
+        self.spotify_url = spotify_url
+        self.thumbnail = sys.intern(thumbnail) if thumbnail else None
+        self._query = query # None -> dibangun dari artis & judul saat dibutuhkan
+        self.duration = duration # Detik (dari Spotify); None jika tidak diketahui
+
+    @property
+    def query_for_yt_dlp(self):
+        return self._query or f"{self.artist} - {self.title} audio"
+
+    @property
+    def label(self):
+        return f"{self.artist} - {self.title}".strip(" - ") if self.artist else self.title
+
+class GuildQueue:
+    # Antrian berbasis dict berindeks (head/tail): operasi depan/belakang & peek berindeks O(1)
+    __slots__ = ('_items', '_head', '_tail', 'version', 'duration', 'unknown_durations')
+
+    def __init__(self, items=()):
+        self._items = {}; self._head = self._tail = 0
+        self.version = 0 # Naik setiap antrian berubah (untuk cache tampilan)
+        self.duration = 0; self.unknown_durations = 0 # Total durasi diperbarui tiap operasi, tanpa memindai ulang antrian
+        self.extend(items)
+
+    def _account(self, item, sign):
+        duration = getattr(item, 'duration', None)
+        if duration: self.duration += sign * duration
+        else: self.unknown_durations += sign
+
+    def __len__(self): return self._tail - self._head
+    def __bool__(self): return self._tail > self._head
+
+    def __iter__(self):
+        items = self._items
+        return (items[i] for i in range(self._head, self._tail))
+
+    def _pos(self, index):
+        if index < 0: index += len(self)
+        if not 0 <= index < len(self): raise IndexError('Posisi antrian di luar jangkauan')
+        return self._head + index
+
+    def __getitem__(self, index):
+        if isinstance(index, slice): return [self._items[self._head + i] for i in range(*index.indices(len(self)))]
+        return self._items[self._pos(index)]
+
+    def peek(self, index=0):
+        return self[index] if -len(self) <= index < len(self) else None
+
+    def append(self, item):
+        self._items[self._tail] = item; self._tail += 1; self.version += 1; self._account(item, 1)
+
+    def appendleft(self, item):
+        self._head -= 1; self._items[self._head] = item; self.version += 1; self._account(item, 1)
+
+    def extend(self, items):
+        for item in items: self.append(item)
+
+    def popleft(self):
+        if not self: raise IndexError('Antrian kosong')
+        item = self._items.pop(self._head); self._head += 1; self.version += 1; self._account(item, -1)
+        return item
+
+    def pop(self):
+        if not self: raise IndexError('Antrian kosong')
+        self._tail -= 1; self.version += 1
+        item = self._items.pop(self._tail); self._account(item, -1)
+        return item
+
+    def clear(self):
+        self._items.clear(); self._head = self._tail = 0; self.version += 1; self.duration = self.unknown_durations = 0
+
+    def remove_at(self, index):
+        # Geser sisi yang lebih pendek, tanpa membangun ulang seluruh antrian
+        pos = self._pos(index); items = self._items; item = items[pos]
+        if pos - self._head < self._tail - 1 - pos:
+            for i in range(pos, self._head, -1): items[i] = items[i - 1]
+            del items[self._head]; self._head += 1
+        else:
+            for i in range(pos, self._tail - 1): items[i] = items[i + 1]
+            self._tail -= 1; del items[self._tail]
+        self.version += 1; self._account(item, -1)
+        return item
+
+    def insert(self, index, item):
+        index = max(0, min(index if index >= 0 else index + len(self), len(self))); items = self._items
+        if index < len(self) - index:
+            self._head -= 1
+            for i in range(self._head, self._head + index): items[i] = items[i + 1]
+        else:
+            for i in range(self._tail, self._head + index, -1): items[i] = items[i - 1]
+            self._tail += 1
+        items[self._head + index] = item; self.version += 1; self._account(item, 1)
+
+    def move(self, src, dst):
+        item = self.remove_at(src); self.insert(dst, item)
+        return item
+
+    def shuffle(self):
+        items = list(self); random.shuffle(items)
+        self._items = dict(zip(range(self._head, self._tail), items)); self.version += 1
+
+    def memory_usage(self):
+        # Perkiraan byte: struktur + item + string unik (string yang di-intern dihitung sekali)
+        total = sys.getsizeof(self) + sys.getsizeof(self._items) + sum(sys.getsizeof(k) for k in self._items); seen = set()
+        for item in self:
+            total += sys.getsizeof(item)
+            for value in ((item.title, item.artist, item.spotify_url, item.thumbnail, item._query) if isinstance(item, QueuedTrack) else (item,)):
+                if value is not None and id(value) not in seen: seen.add(id(value)); total += sys.getsizeof(value)
+        return total
+
+# --- State Pemutar per Guild ---
+class GuildPlayer:
+    # Semua state pemutar satu guild dalam satu objek, jadi tidak ada state lintas guild/shard di global
+    __slots__ = ('guild_id', 'queue', 'current_song', 'now_playing_message', 'autoplay', 'history', 'prefetch', 'imports', 'scheduler', 'text_channel_id', 'seek_on_start', 'recent_ids', 'autoplay_seed', 'sources', 'resume_task', 'breaker_paused', 'gapless_task', 'queue_pages', 'halted', 'history_label')
+
+    def __init__(self, guild_id):
+        self.guild_id = guild_id
+        self.queue = GuildQueue()
+        self.current_song = None # Info lagu yang sedang diputar (dict)
+        self.now_playing_message = None
+        self.autoplay = False
+        self.history = None # Item terakhir yang diputar (untuk replay & autoplay)
+        self.history_label = None # "uploader judul" lagu terakhir; acuan pencarian autoplay jika history berupa URL
+        self.prefetch = {} # query -> asyncio.Task hasil resolve lagu berikutnya
+        self.imports = set() # asyncio.Task import playlist Spotify yang masih berjalan
+        self.scheduler = TransitionScheduler(guild_id)
+        self.text_channel_id = None # Channel teks tempat Now Playing dikirim
+        self.seek_on_start = None # (item, detik): item ini dimulai dari posisi tsb (lanjutan setelah restart)
+        self.recent_ids = deque(maxlen=AUTOPLAY_RECENT_WINDOW) # ID video yang baru diputar (seed & dedupe autoplay)
+        self.autoplay_seed = None # Seed yang kandidatnya sedang dipakai autoplay
+        self.sources = weakref.WeakSet() # Source ffmpeg yang pernah dibuat guild ini (untuk membunuh proses sisa saat teardown)
+        self.resume_task = None; self.breaker_paused = False # Antrian dijeda karena circuit breaker ekstraksi terbuka
+        self.gapless_task = None # Task yang menyiapkan lagu berikutnya menjelang akhir lagu (mode gapless)
+        self.queue_pages = (-1, {}) # (versi antrian, {halaman: teks}); dibuang otomatis saat antrian berubah
+        self.halted = False # Antrian dijeda setelah TRANSITION_MAX_FAILURES gagal beruntun (menunggu resume)
+
+    def queue_held(self):
+        # Antrian sengaja ditahan (breaker/gagal beruntun): VC diam tapi jangan dianggap idle oleh reaper
+        return self.breaker_paused or self.halted or bool(self.resume_task and not self.resume_task.done())
+
+    def cancel_background(self):
+        for task in self.prefetch.values(): task.cancel()
+        for task in self.imports: task.cancel()
+        if self.resume_task: self.resume_task.cancel(); self.resume_task = None
+        if self.gapless_task: self.gapless_task.cancel(); self.gapless_task = None
+        self.prefetch.clear(); self.imports.clear()
+
+players = {} # guild_id -> GuildPlayer (hanya guild milik shard di proses ini)
+
+def get_player(guild_id):
+    player = players.get(guild_id)
+    if player is None: player = players[guild_id] = GuildPlayer(guild_id)
+    return player
+
+def find_player(guild_id):
+    return players.get(guild_id)
+
+def find_queue(guild_id):
+    player = players.get(guild_id)
+    return player.queue if player else None
+
+def release_player(guild_id):
+    # Dipakai stop: buang seluruh state guild & hentikan pekerjaan background-nya
+    player = players.pop(guild_id, None)
+    if player: player.cancel_background(); player.queue.clear()
+    message_updates.forget(guild_id); autoplay_engine.forget(guild_id); reaper.forget(guild_id)
+    if state_store: state_store.forget(guild_id)
+    return player
 
 # --- Custom Help Command ---
 class CustomHelpCommand(commands.DefaultHelpCommand):
@@ -79,19 +360,117 @@ class CustomHelpCommand(commands.DefaultHelpCommand):
         embed.set_footer(text=self.get_ending_note())
         await self.get_destination().send(embed=embed)
 
-bot = commands.Bot(command_prefix=BOT_PREFIX, intents=intents, help_command=CustomHelpCommand())
+class MusicBotLifecycle:
+    # Hook start/stop proses; dipakai baik oleh Bot biasa maupun AutoShardedBot
+    async def setup_hook(self):
+        install_shutdown_handler()
 
-# --- Setup Spotipy (Spotify API Client) ---
-sp = None
-if SPOTIPY_CLIENT_ID and SPOTIPY_CLIENT_SECRET:
-    try:
-        auth_manager = SpotifyClientCredentials(client_id=SPOTIPY_CLIENT_ID, client_secret=SPOTIPY_CLIENT_SECRET)
-        sp = spotipy.Spotify(auth_manager=auth_manager)
-        print("Berhasil terhubung ke Spotify API.")
-    except Exception as e:
-        print(f"Gagal menghubungkan ke Spotify API: {e}.")
-else:
-    print("Kredensial Spotify tidak lengkap, fitur Spotify dinonaktifkan.")
+    async def close(self):
+        # Flush state sebelum voice client diputus, selagi posisi lagu masih terbaca
+        if state_store: await state_store.close()
+        await super().close()
+
+class MusicBot(MusicBotLifecycle, commands.Bot): pass
+class ShardedMusicBot(MusicBotLifecycle, commands.AutoShardedBot): pass
+
+bot_options = dict(command_prefix=BOT_PREFIX, intents=intents, help_command=CustomHelpCommand())
+if SHARD_MODE == 'auto' or SHARD_IDS:
+    if SHARD_COUNT: bot_options['shard_count'] = SHARD_COUNT
+    if SHARD_IDS: bot_options['shard_ids'] = SHARD_IDS
+    bot = ShardedMusicBot(**bot_options)
+else: bot = MusicBot(**bot_options)
+
+# --- Import Berat Secara Lazy (yt_dlp & spotipy) ---
+_youtube_dl = None
+
+def load_youtube_dl():
+    # Dipanggil dari thread/proses ekstraksi; import lock Python menjaga agar modul hanya dimuat sekali
+    global _youtube_dl
+    if _youtube_dl is None:
+        started = time.perf_counter()
+        import yt_dlp
+        _youtube_dl = yt_dlp; record_startup_phase('import yt_dlp', started)
+    return _youtube_dl
+
+def _warm_youtube_dl():
+    load_youtube_dl() # Modul tidak bisa di-pickle: worker proses cukup memuatnya, tanpa mengembalikan apa pun
+
+# --- Setup Spotipy (Spotify API Client, dibuat saat pertama dipakai) ---
+SPOTIFY_ENABLED = bool(SPOTIPY_CLIENT_ID and SPOTIPY_CLIENT_SECRET)
+sp = None; spotify_api = None
+_spotify_lock = threading.Lock()
+if not SPOTIFY_ENABLED: print("Kredensial Spotify tidak lengkap, fitur Spotify dinonaktifkan.")
+
+# --- Lapisan Async Spotify (semua panggilan spotipy dijalankan di luar event loop) ---
+class SpotifyAsync:
+    PLAYLIST_PAGE_SIZE = 100
+    ALBUM_PAGE_SIZE = 50
+    PLAYLIST_FIELDS = 'items(track(name,artists(name),external_urls(spotify),album(images),duration_ms)),next,total'
+
+    def __init__(self, client, max_concurrency):
+        self.client = client
+        self._executor = ThreadPoolExecutor(max_workers=max(1, max_concurrency), thread_name_prefix='spotify')
+        self._semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+    async def _call(self, fn, *args, **kwargs):
+        started = time.perf_counter()
+        async with self._semaphore:
+            try: return await asyncio.get_running_loop().run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+            finally: metrics.observe('spotify', time.perf_counter() - started)
+
+    async def track(self, track_id): return await self._call(self.client.track, track_id)
+    async def album(self, album_id): return await self._call(self.client.album, album_id)
+    async def playlist(self, playlist_id): return await self._call(self.client.playlist, playlist_id, fields='name,images')
+
+    async def _paged(self, fetch_page, page_size, first_page=None):
+        # Halaman pertama menentukan total; sisanya diambil paralel (dibatasi semaphore) tapi di-yield berurutan
+        first_page = first_page or await fetch_page(0)
+        yield first_page
+        tasks = [asyncio.ensure_future(fetch_page(offset)) for offset in range(len(first_page['items']), first_page.get('total') or 0, page_size)]
+        try:
+            for task in tasks: yield await task
+        finally:
+            for task in tasks:
+                task.cancel()
+                if task.done() and not task.cancelled(): task.exception() # Tandai sudah diambil agar tidak ada warning
+    
+    def album_track_pages(self, album_id, first_page=None):
+        return self._paged(lambda offset: self._call(self.client.album_tracks, album_id, limit=self.ALBUM_PAGE_SIZE, offset=offset), self.ALBUM_PAGE_SIZE, first_page)
+
+    def playlist_pages(self, playlist_id):
+        return self._paged(lambda offset: self._call(self.client.playlist_items, playlist_id, fields=self.PLAYLIST_FIELDS, limit=self.PLAYLIST_PAGE_SIZE, offset=offset), self.PLAYLIST_PAGE_SIZE)
+
+def get_spotify_api():
+    # Blocking (import spotipy + buat client): panggil lewat ensure_spotify_api() dari event loop
+    global sp, spotify_api
+    with _spotify_lock:
+        if spotify_api is None and SPOTIFY_ENABLED:
+            started = time.perf_counter()
+            try:
+                import spotipy
+                from spotipy.oauth2 import SpotifyClientCredentials
+                sp = spotipy.Spotify(auth_manager=SpotifyClientCredentials(client_id=SPOTIPY_CLIENT_ID, client_secret=SPOTIPY_CLIENT_SECRET))
+                spotify_api = SpotifyAsync(sp, SPOTIFY_MAX_CONCURRENCY)
+                print("Berhasil terhubung ke Spotify API.")
+            except Exception as e: print(f"Gagal menghubungkan ke Spotify API: {e}.")
+            record_startup_phase('client spotify', started)
+    return spotify_api
+
+async def ensure_spotify_api():
+    return spotify_api or (await asyncio.to_thread(get_spotify_api) if SPOTIFY_ENABLED else None)
+
+def spotify_track_to_item(track, thumbnail, spotify_url=None):
+    duration = track.get('duration_ms')
+    return QueuedTrack(track['name'], track['artists'][0]['name'], spotify_url or track.get('external_urls',{}).get('spotify'), thumbnail, duration=round(duration / 1000) if duration else None)
+
+def spotify_playlist_page_to_items(page_items, fallback_thumbnail):
+    items = []
+    for item_wrapper in page_items:
+        item = item_wrapper.get('track')
+        if item and item.get('name') and item.get('artists'):
+            thumb = item.get('album', {}).get('images'); thumb_url = thumb[0]['url'] if thumb else fallback_thumbnail
+            items.append(spotify_track_to_item(item, thumb_url))
+    return items
 
 # --- Opsi untuk yt-dlp & FFmpeg ---
 YDL_OPTS = {
@@ -103,11 +482,327 @@ YDL_OPTS = {
 }
 FFMPEG_OPTS = {'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5', 'options': '-vn'}
 
+# --- Cache Hasil Resolve yt-dlp (dibagi antar guild) ---
+RESOLVED_FIELDS = ('id', 'title', 'webpage_url', 'duration', 'uploader', 'thumbnail', 'url', 'acodec', 'ext')
+
+class ResolveCache:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict() # kunci ternormalisasi -> (expires_at, data)
+        self.hits = self.misses = self.expired = self.evicted = 0
+
+    @staticmethod
+    def normalize(query):
+        text = str(query or '').strip()
+        if re.match(r'https?://', text, re.IGNORECASE): return text # ID video & path URL peka huruf besar/kecil
+        return ' '.join(text.lower().split()) # Hanya query pencarian bebas yang disamakan
+
+    @staticmethod
+    def stream_expiry(data):
+        # URL googlevideo membawa ?expire=<unix time>; hormati itu agar tidak memutar URL mati
+        try: return int(urllib.parse.parse_qs(urllib.parse.urlparse(data.get('url', '')).query)['expire'][0])
+        except (KeyError, IndexError, ValueError): return None
+
+    def get(self, query):
+        key = self.normalize(query); entry = self._entries.get(key)
+        if entry is None: self.misses += 1; return None
+        expires_at, data = entry
+        if time.time() >= expires_at:
+            del self._entries[key]; self.expired += 1; self.misses += 1; return None
+        self._entries.move_to_end(key); self.hits += 1
+        return dict(data)
+
+    def put(self, query, data):
+        if self.max_size <= 0 or not data.get('url'): return
+        expires_at = (self.stream_expiry(data) or time.time() + RESOLVE_CACHE_TTL) - RESOLVE_CACHE_MARGIN
+        if expires_at <= time.time(): return
+        entry = (expires_at, {k: data[k] for k in RESOLVED_FIELDS if k in data})
+        for key in {self.normalize(query), self.normalize(data.get('webpage_url'))}:
+            if not key: continue
+            self._entries[key] = entry; self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size: self._entries.popitem(last=False); self.evicted += 1
+
+    def invalidate_url(self, stream_url):
+        # Buang semua kunci yang menunjuk ke URL stream yang sudah mati
+        for key in [k for k, (_, data) in self._entries.items() if data.get('url') == stream_url]: del self._entries[key]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses, 'expired': self.expired, 'evicted': self.evicted, 'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0}
+
+resolve_cache = ResolveCache(RESOLVE_CACHE_SIZE)
+
+# --- Pool Ekstraksi yt-dlp (terpisah dari default executor) ---
+def _ydl_extract(ydl_opts, query_to_search, download, slim):
+    # Berjalan di thread/proses worker; hasil dipangkas agar murah di-pickle & disimpan
+    with load_youtube_dl().YoutubeDL(ydl_opts) as ydl:
+        data = ydl.extract_info(query_to_search, download=download)
+        if 'entries' in data:
+            data = next((entry for entry in data['entries'] or [] if entry), None)
+            if data is None: raise NoSearchResult(f"Tidak ada hasil untuk '{query_to_search}'")
+        filename = ydl.prepare_filename(data) if download else data['url']
+    if slim: data = {k: data[k] for k in RESOLVED_FIELDS if k in data}
+    return data, filename
+
+class NoSearchResult(Exception):
+    pass
+
+SYSTEMIC_EXTRACT_ERRORS = ('http error 429', 'too many requests', 'http error 403', '403: forbidden', 'sign in to confirm', 'not a bot')
+
+def is_systemic_extract_error(error):
+    # Throttling/bot check = masalah seluruh bot; pencarian kosong, video privat/dihapus = masalah query itu saja
+    message = str(error).lower()
+    return any(marker in message for marker in SYSTEMIC_EXTRACT_ERRORS)
+
+class ExtractionPaused(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f"Ekstraksi dijeda ~{retry_after:.0f} detik (circuit breaker)")
+        self.retry_after = retry_after
+
+class CircuitBreaker:
+    # closed -> open (saat rasio gagal melonjak) -> half_open (satu probe) -> closed / open lagi dengan backoff lebih panjang
+    def __init__(self, window, min_failures, failure_rate, base_backoff, max_backoff):
+        self.window = window; self.min_failures = min_failures; self.failure_rate = failure_rate
+        self.base_backoff = base_backoff; self.max_backoff = max_backoff
+        self.outcomes = deque() # (monotonic, berhasil?) dalam jendela geser
+        self.state = 'closed'; self.open_until = 0.0; self.trips = 0; self.probing = False
+        self.total_trips = self.rejected = 0
+
+    def before_call(self):
+        # True jika panggilan ini probe half-open; ExtractionPaused jika harus menunggu
+        if self.state == 'closed': return False
+        if self.state == 'open' and time.monotonic() >= self.open_until: self.state = 'half_open'
+        if self.state == 'half_open' and not self.probing: self.probing = True; return True
+        self.rejected += 1
+        raise ExtractionPaused(self.retry_after())
+
+    def retry_after(self):
+        if self.state == 'closed': return 0.0
+        return max(self.open_until - time.monotonic(), 0.0) or self.base_backoff / 2 # Half-open: tunggu hasil probe
+
+    def record(self, ok, probe=False):
+        now = time.monotonic()
+        if probe:
+            self.probing = False
+            if not ok: self._trip(now); return
+            self.state = 'closed'; self.trips = 0; self.outcomes.clear(); print("Circuit breaker yt-dlp: pulih, ekstraksi normal lagi."); return
+        if self.state != 'closed': return # Hasil panggilan yang sudah berjalan sebelum breaker terbuka
+        self.outcomes.append((now, ok))
+        while now - self.outcomes[0][0] > self.window: self.outcomes.popleft()
+        if ok: return
+        failures = sum(1 for _, succeeded in self.outcomes if not succeeded)
+        if failures >= self.min_failures and failures / len(self.outcomes) >= self.failure_rate: self._trip(now)
+
+    def abandon(self, probe):
+        if probe: self.probing = False # Probe dibatalkan; pemanggil berikutnya boleh jadi probe
+
+    def _trip(self, now):
+        backoff = min(self.max_backoff, self.base_backoff * 2 ** self.trips)
+        backoff = backoff / 2 + random.uniform(0, backoff / 2) # Equal jitter: guild/proses tidak mencoba lagi serentak
+        self.state = 'open'; self.open_until = now + backoff; self.trips += 1; self.total_trips += 1
+        print(f"Circuit breaker yt-dlp: terbuka {backoff:.0f} detik (trip beruntun ke-{self.trips}).")
+
+extraction_breaker = CircuitBreaker(BREAKER_WINDOW, BREAKER_MIN_FAILURES, BREAKER_FAILURE_RATE, BREAKER_BASE_BACKOFF, BREAKER_MAX_BACKOFF)
+
+class ExtractionPool:
+    def __init__(self, workers, mode):
+        self.workers = max(1, workers); self.mode = mode
+        self.executor = ProcessPoolExecutor(max_workers=self.workers) if mode == 'process' else ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='ytdl')
+        self._active = 0
+        self.limit = float(self.workers); self._last_decrease = 0.0 # Batas konkurensi adaptif (AIMD), <= workers
+        self._waiting = OrderedDict() # guild_id -> deque(Future); dilayani bergiliran (round-robin) antar guild
+        self.submitted = self.completed = self.failed = 0
+        self.wait_total = self.wait_max = 0.0
+
+    def queue_depth(self):
+        return sum(len(waiters) for waiters in self._waiting.values())
+
+    async def _acquire(self, guild_id):
+        if self._active < int(self.limit) and not self._waiting: self._active += 1; return
+        fut = asyncio.get_running_loop().create_future()
+        self._waiting.setdefault(guild_id, deque()).append(fut)
+        try: await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled(): self._release() # Slot sudah diberikan, teruskan ke antrian berikutnya
+            else:
+                waiters = self._waiting.get(guild_id)
+                if waiters and fut in waiters:
+                    waiters.remove(fut)
+                    if not waiters: del self._waiting[guild_id]
+            raise
+
+    def _release(self):
+        self._active -= 1; self._grant()
+
+    def _grant(self):
+        while self._waiting and self._active < int(self.limit):
+            guild_id, waiters = next(iter(self._waiting.items()))
+            fut = waiters.popleft()
+            if waiters: self._waiting.move_to_end(guild_id) # Guild ini antre lagi di belakang
+            else: del self._waiting[guild_id]
+            if not fut.done(): fut.set_result(None); self._active += 1
+
+    def _adapt(self, ok):
+        # Naik +1/limit per sukses, turun setengah saat gagal (maks. sekali per detik agar satu burst tidak langsung ke 1)
+        if ok: self.limit = min(float(self.workers), self.limit + 1 / self.limit); self._grant(); return
+        now = time.monotonic()
+        if now - self._last_decrease >= 1.0: self.limit = max(1.0, self.limit / 2); self._last_decrease = now
+
+    async def run(self, guild_id, fn, *args, on_result=None):
+        # on_result dipanggil dengan hasil sukses walau pemanggil sudah dibatalkan (mis. prefetch yang dibuang)
+        probe = extraction_breaker.before_call()
+        started = time.monotonic()
+        try: await self._acquire(guild_id)
+        except asyncio.CancelledError: extraction_breaker.abandon(probe); raise
+        waited = time.monotonic() - started
+        self.submitted += 1; self.wait_total += waited; self.wait_max = max(self.wait_max, waited); metrics.observe('extract_wait', waited)
+        future = asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+        future.add_done_callback(functools.partial(self._finish, probe, time.monotonic(), on_result))
+        return await asyncio.shield(future) # Batal di pemanggil tidak melepas slot: worker masih bekerja sampai future selesai
+
+    def _finish(self, probe, started, on_result, future):
+        self._release(); metrics.observe('extract', time.monotonic() - started)
+        if future.cancelled(): extraction_breaker.abandon(probe); return
+        error = future.exception()
+        if error:
+            self.failed += 1; systemic = is_systemic_extract_error(error)
+            extraction_breaker.record(not systemic, probe) # Error per query tetap bukti YouTube menjawab normal
+            if systemic: self._adapt(False)
+            return
+        self.completed += 1; extraction_breaker.record(True, probe); self._adapt(True)
+        if on_result: on_result(future.result())
+
+    def stats(self):
+        return {'mode': self.mode, 'workers': self.workers, 'limit': round(self.limit, 2), 'breaker': extraction_breaker.state, 'active': self._active, 'queue_depth': self.queue_depth(), 'submitted': self.submitted, 'completed': self.completed, 'failed': self.failed,
+                'wait_avg': round(self.wait_total / self.submitted, 4) if self.submitted else 0.0, 'wait_max': round(self.wait_max, 4)}
+
+extraction_pool = ExtractionPool(EXTRACT_WORKERS, EXTRACT_POOL_MODE)
+
+# --- Cache Audio di Disk (lagu yang sering diputar) ---
+def _ydl_download_audio(ydl_opts, url):
+    with load_youtube_dl().YoutubeDL(ydl_opts) as ydl:
+        info = ydl.extract_info(url, download=True)
+    downloads = info.get('requested_downloads') or []
+    return downloads[0].get('filepath') if downloads else None
+
+class AudioDiskCache:
+    INDEX_SAVE_DELAY = 30 # Detik; urutan LRU dari cache hit ditulis berkelompok, bukan per hit
+
+    def __init__(self, directory, max_bytes, min_plays):
+        self.directory = directory; self.max_bytes = max_bytes; self.min_plays = min_plays
+        self.index_path = os.path.join(directory, 'index.json')
+        self.entries = OrderedDict() # video_id -> {'path', 'size', 'meta'}; urutan = LRU
+        self.queries = {} # query ternormalisasi -> video_id
+        self.play_counts = OrderedDict() # video_id -> jumlah putar (dibatasi)
+        self.downloading = set()
+        self.total_bytes = 0
+        self.hits = self.misses = self.downloads = self.download_failures = self.evictions = 0
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='audiocache') # Tulis index (satu thread -> urutan tulis terjaga)
+        self._download_slot = asyncio.Semaphore(1) # Unduhan latar belakang antre satu per satu, maks. satu slot ekstraksi
+        self._save_task = None
+
+    def load(self):
+        os.makedirs(self.directory, exist_ok=True)
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f: index = json.load(f)
+        except (OSError, ValueError): index = {}
+        for video_id, entry in index.get('entries', []):
+            if os.path.exists(entry['path']): self.entries[video_id] = entry; self.total_bytes += entry['size']
+        # Kunci URL dari index lama bisa sudah di-lowercase; hanya webpage_url yang dipercaya, alias lain dipelajari ulang oleh record_play
+        self.queries = {q: vid for q, vid in index.get('queries', {}).items() if vid in self.entries and (not re.match(r'https?://', q) or q == self.entries[vid]['meta'].get('webpage_url'))}
+        print(f"Cache audio: {len(self.entries)} lagu, {self.total_bytes / 1024**2:.1f} MiB.")
+
+    def _write_index(self, index):
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f: json.dump(index, f)
+        os.replace(tmp_path, self.index_path)
+
+    async def _save_index(self):
+        # Snapshot diambil di event loop, serialisasi & tulis di executor cache (satu thread -> urutan tulis terjaga)
+        index = {'entries': list(self.entries.items()), 'queries': dict(self.queries)}
+        try: await asyncio.get_running_loop().run_in_executor(self._executor, self._write_index, index)
+        except OSError as e: print(f"Cache audio: gagal menyimpan index: {e}")
+
+    def lookup(self, query):
+        # Tanpa I/O di event loop: file divalidasi saat load() dan hanya dihapus oleh _evict()
+        video_id = self.queries.get(ResolveCache.normalize(query)); entry = self.entries.get(video_id)
+        if not entry: self.misses += 1; return None
+        self.entries.move_to_end(video_id); self.hits += 1
+        if not self._save_task: self._save_task = spawn_task(self._save_later())
+        return dict(entry['meta'], url=entry['path'], _local=True)
+
+    async def _save_later(self):
+        try: await asyncio.sleep(self.INDEX_SAVE_DELAY)
+        finally: self._save_task = None
+        await self._save_index()
+
+    def record_play(self, query, data):
+        video_id = data.get('id')
+        if not video_id or data.get('_local'): return
+        if video_id in self.entries:
+            self.queries[ResolveCache.normalize(query)] = video_id; return
+        self.play_counts[video_id] = self.play_counts.get(video_id, 0) + 1; self.play_counts.move_to_end(video_id)
+        while len(self.play_counts) > 5000: self.play_counts.popitem(last=False)
+        if self.play_counts[video_id] >= self.min_plays and video_id not in self.downloading:
+            self.downloading.add(video_id)
+            spawn_task(self._download(video_id, query, data))
+
+    async def _download(self, video_id, query, data):
+        ydl_opts = {'format': 'bestaudio[acodec=opus]/bestaudio/best', 'outtmpl': os.path.join(self.directory, f'{video_id}.%(ext)s'), 'noplaylist': True, 'quiet': True, 'no_warnings': True,
+                    'postprocessors': [{'key': 'FFmpegExtractAudio', 'preferredcodec': 'opus'}]} # Opus disimpan apa adanya (remux), tanpa encode ulang
+        try:
+            async with self._download_slot: # Lewat pool & circuit breaker: unduhan ikut berhenti saat YouTube membatasi
+                path = await extraction_pool.run(None, _ydl_download_audio, ydl_opts, data.get('webpage_url') or f"https://www.youtube.com/watch?v={video_id}")
+            path = path if path and os.path.exists(path) else next(iter(glob.glob(os.path.join(glob.escape(self.directory), f'{glob.escape(video_id)}.*'))), None)
+            if not path: raise FileNotFoundError(video_id)
+        except ExtractionPaused: print(f"Cache audio: unduhan {video_id} ditunda (circuit breaker)."); return # Jumlah putar tetap, dicoba lagi di putaran berikutnya
+        except Exception as e:
+            self.download_failures += 1; print(f"Cache audio gagal unduh {video_id}: {e}"); return
+        finally: self.downloading.discard(video_id)
+        meta = {k: data[k] for k in ('id', 'title', 'webpage_url', 'duration', 'uploader', 'thumbnail') if k in data}
+        meta['acodec'] = 'opus' if path.endswith('.opus') else None
+        size = os.path.getsize(path)
+        self.entries[video_id] = {'path': path, 'size': size, 'meta': meta}; self.total_bytes += size; self.downloads += 1
+        for key in {ResolveCache.normalize(query), ResolveCache.normalize(data.get('webpage_url'))}:
+            if key: self.queries[key] = video_id
+        self.play_counts.pop(video_id, None)
+        self._evict()
+        await self._save_index()
+
+    def _evict(self):
+        evicted = set()
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            video_id, entry = self.entries.popitem(last=False)
+            self.total_bytes -= entry['size']; self.evictions += 1; evicted.add(video_id)
+            try: os.remove(entry['path'])
+            except OSError: pass
+        if evicted: self.queries = {q: vid for q, vid in self.queries.items() if vid not in evicted}
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'entries': len(self.entries), 'bytes': self.total_bytes, 'hits': self.hits, 'misses': self.misses, 'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+                'downloads': self.downloads, 'download_failures': self.download_failures, 'evictions': self.evictions, 'downloading': len(self.downloading)}
+
+def audio_cache_location():
+    # Mode cluster: tiap proses punya direktori & index sendiri (tidak saling evict), anggaran disk dibagi sesuai porsi shard-nya
+    if CLUSTER_ID is None: return AUDIO_CACHE_DIR, AUDIO_CACHE_MAX_BYTES
+    share = len(SHARD_IDS) / SHARD_COUNT if SHARD_IDS and SHARD_COUNT else 1
+    return os.path.join(AUDIO_CACHE_DIR, f'cluster-{CLUSTER_ID}'), int(AUDIO_CACHE_MAX_BYTES * share)
+
+audio_cache = AudioDiskCache(*audio_cache_location(), AUDIO_CACHE_MIN_PLAYS) if AUDIO_CACHE_ENABLED else None
+if audio_cache: audio_cache.load()
+
+def ffmpeg_before_options(data, start_at=0):
+    options = [] if data.get('_local') else [FFMPEG_OPTS['before_options']] # Opsi reconnect hanya untuk stream HTTP
+    if start_at: options.insert(0, f"-ss {start_at:.2f}")
+    return ' '.join(options) or None
+
 # --- Class YTDLSource ---
-class YTDLSource(discord.PCMVolumeTransformer):
-    def __init__(self, source, *, data, volume=0.5):
-        super().__init__(source, volume)
+class TrackInfoMixin:
+    def _set_track_info(self, data, start_at=0):
         self.data = data
+        self.start_offset = start_at; self.frames_read = 0 # Posisi = offset awal + jumlah frame 20 ms yang sudah dibaca
+        self.stop_requested = False; self.recoveries = 0; self.play_requested_at = None
         self.title = data.get('title', 'Judul Tidak Diketahui')
         self.url = data.get('webpage_url', '') 
         self.duration = data.get('duration')
@@ -115,22 +810,407 @@ class YTDLSource(discord.PCMVolumeTransformer):
         self.thumbnail = data.get('thumbnail')
         self.original_query_info = data.get('original_query_info')
 
+    def read(self):
+        chunk = super().read()
+        if chunk:
+            if not self.frames_read and self.play_requested_at: metrics.observe('first_packet', time.perf_counter() - self.play_requested_at)
+            self.frames_read += 1
+        return chunk
+
+    @property
+    def position(self):
+        return self.start_offset + self.frames_read * 0.02
+
+class YTDLSource(TrackInfoMixin, discord.PCMVolumeTransformer):
+    def __init__(self, source, *, data, volume=PLAYBACK_VOLUME, start_at=0):
+        super().__init__(source, volume)
+        self._set_track_info(data, start_at)
+
+    @staticmethod
+    def query_of(item_data_or_query):
+        return item_data_or_query.query_for_yt_dlp if isinstance(item_data_or_query, QueuedTrack) else str(item_data_or_query)
+
     @classmethod
-    async def from_url(cls, item_data_or_query, *, loop=None, stream=False, ydl_opts_override=None):
-        loop = loop or asyncio.get_event_loop()
+    async def extract_data(cls, item_data_or_query, *, stream=False, ydl_opts_override=None, guild_id=None):
+        # Hanya resolve info (tanpa spawn FFmpeg), dipakai juga oleh prefetch
         final_ydl_opts = YDL_OPTS.copy()
         if ydl_opts_override: final_ydl_opts.update(ydl_opts_override)
-        query_to_search = str(item_data_or_query.get('query_for_yt_dlp', item_data_or_query)) if isinstance(item_data_or_query, dict) else str(item_data_or_query)
-        original_info_for_player = item_data_or_query
+        query_to_search = cls.query_of(item_data_or_query)
         if not re.match(r'http[s]?://', query_to_search): final_ydl_opts['default_search'] = 'ytsearch1'
         elif 'default_search' in final_ydl_opts: del final_ydl_opts['default_search']
+        data = (audio_cache and audio_cache.lookup(query_to_search) or resolve_cache.get(query_to_search)) if stream else None
+        if data is not None: filename = data['url']
+        else:
+            cache_result = (lambda result: resolve_cache.put(query_to_search, result[0])) if stream else None # Tetap di-cache walau prefetch dibatalkan
+            try: data, filename = await extraction_pool.run(guild_id, _ydl_extract, final_ydl_opts, query_to_search, not stream, stream, on_result=cache_result)
+            except ExtractionPaused: raise
+            except Exception as e: print(f"Error yt-dlp: {e}"); raise 
+        data['original_query_info'] = item_data_or_query
+        data['_filename'] = filename
+        data['_resolved_at'] = time.monotonic()
+        return data
+
+    @classmethod
+    def from_data(cls, data, start_at=0):
+        source = cls(discord.FFmpegPCMAudio(data['_filename'], before_options=ffmpeg_before_options(data, start_at), options=FFMPEG_OPTS['options']), data=data, start_at=start_at)
+        playback_path_counts['pcm'] += 1
+        return source
+
+# --- Jalur Playback Opus (tanpa decode PCM & volume di Python) ---
+playback_path_counts = {'opus_copy': 0, 'opus_encode': 0, 'pcm': 0, 'pcm_fallback': 0}
+
+class YTDLOpusSource(TrackInfoMixin, discord.FFmpegOpusAudio):
+    def __init__(self, source, *, data, start_at=0, **ffmpeg_kwargs):
+        super().__init__(source, **ffmpeg_kwargs)
+        self._set_track_info(data, start_at)
+
+    @classmethod
+    def from_data(cls, data, start_at=0):
+        # Stream sudah Opus (mis. webm/251) & volume 1.0 -> diteruskan apa adanya; selain itu ffmpeg yang encode Opus + atur volume
+        passthrough = data.get('acodec') == 'opus' and PLAYBACK_VOLUME == 1.0
+        options = FFMPEG_OPTS['options'] if passthrough or PLAYBACK_VOLUME == 1.0 else f"{FFMPEG_OPTS['options']} -filter:a volume={PLAYBACK_VOLUME}"
+        source = cls(data['_filename'], data=data, start_at=start_at, codec='opus' if passthrough else None, bitrate=OPUS_BITRATE, before_options=ffmpeg_before_options(data, start_at), options=options)
+        playback_path_counts['opus_copy' if passthrough else 'opus_encode'] += 1
+        return source
+
+def create_audio_source(data, start_at=0):
+    started = time.perf_counter()
+    try:
+        if PLAYBACK_ENGINE == 'opus':
+            try: return YTDLOpusSource.from_data(data, start_at)
+            except Exception as e: print(f"Jalur Opus gagal, kembali ke PCM: {e}"); playback_path_counts['pcm_fallback'] += 1
+        return YTDLSource.from_data(data, start_at)
+    finally: metrics.observe('ffmpeg_spawn', time.perf_counter() - started)
+
+# --- Mode Gapless: lagu berikutnya disiapkan lebih awal & disambung di thread audio ---
+gapless_stats = {'prepared': 0, 'handoffs': 0, 'dropped': 0, 'failed': 0}
+
+class PreparedTrack:
+    # Lagu berikutnya yang ffmpeg-nya sudah jalan & beberapa detik awalnya sudah di memori
+    __slots__ = ('item', 'data', 'source', 'frames')
+
+    def __init__(self, item, data, source):
+        self.item = item; self.data = data; self.source = source; self.frames = deque()
+
+    def fill(self, count):
+        # Di executor: spawn, koneksi ke server stream & buffering awal terjadi di sini, bukan saat transisi
+        while len(self.frames) < count:
+            chunk = self.source.read()
+            if not chunk: break
+            self.frames.append(chunk)
+
+    def peek(self):
+        # Frame berikutnya tanpa mengonsumsinya; tetap di buffer sampai benar-benar dicampur/diputar
+        if not self.frames:
+            chunk = self.source.read()
+            if not chunk: return b''
+            self.frames.append(chunk)
+        return self.frames[0]
+
+    def read(self):
+        return self.frames.popleft() if self.frames else self.source.read()
+
+_audioop = None
+
+def load_audioop():
+    # Hanya dipakai crossfade; modul deprecated (hilang di Python 3.13) -> tanpa audioop lagu langsung disambung
+    global _audioop
+    if _audioop is None:
+        try: import audioop as module
+        except ImportError: module = False; print("audioop tidak tersedia, GAPLESS_CROSSFADE diabaikan.")
+        _audioop = module
+    return _audioop
+
+class GaplessSource(discord.AudioSource):
+    # Pembungkus yang diputar voice client; saat lagu habis, lagu yang sudah disiapkan langsung disambung tanpa vc.play baru
+    def __init__(self, track, generation, queue):
+        self.track = track; self.generation = generation; self.queue = queue
+        self.feed = track.read; self.next = None; self.on_handoff = None
+        self.lock = threading.Lock(); self.closed = False
+
+    def offer(self, prepared):
+        with self.lock:
+            if self.closed or self.next is not None: return False
+            self.next = prepared; return True
+
+    def _still_next(self, prepared):
+        try: return self.queue.peek() is prepared.item # Antrian diubah (skip/remove/move) -> lagu yang disiapkan tidak dipakai
+        except (IndexError, KeyError): return False # Antrian sedang diubah event loop
+
+    def _crossfade(self, chunk, prepared):
+        remaining = self.track.duration - self.track.position
+        if remaining > GAPLESS_CROSSFADE or self.track.is_opus() or prepared.source.is_opus() or not self._still_next(prepared): return chunk
+        audioop = load_audioop()
+        if not audioop: return chunk # Tanpa audioop: lagu berikutnya diputar utuh setelah sambungan
+        incoming = prepared.peek()
+        if len(incoming) != len(chunk): return chunk # Frame tidak dibuang; diputar normal setelah sambungan
+        prepared.frames.popleft() # Frame yang sudah tercampur tidak diputar ulang setelah sambungan
+        gain = max(0.0, remaining) / GAPLESS_CROSSFADE
+        return audioop.add(audioop.mul(chunk, 2, gain), audioop.mul(incoming, 2, 1.0 - gain), 2)
+
+    def read(self):
+        chunk = self.feed(); prepared = self.next
+        if chunk: return self._crossfade(chunk, prepared) if prepared and GAPLESS_CROSSFADE > 0 and self.track.duration else chunk
+        if not prepared or self.track.stop_requested or needs_stream_recovery(self.track, None) or not self._still_next(prepared): return b'' # Transisi/pemulihan biasa
+        with self.lock: self.next = None
+        previous = self.track; self.track = prepared.source; self.feed = prepared.read
+        if self.on_handoff: self.on_handoff(previous, prepared)
+        return self.feed()
+
+    def is_opus(self):
+        return self.track.is_opus()
+
+    def cleanup(self):
+        with self.lock: self.closed = True; prepared, self.next = self.next, None
+        self.track.cleanup()
+        if prepared: prepared.source.cleanup(); gapless_stats['dropped'] += 1
+
+def current_track_source(vc):
+    source = vc.source if vc else None
+    if isinstance(source, GaplessSource): source = source.track
+    return source if isinstance(source, TrackInfoMixin) else None
+
+def ffmpeg_process(source):
+    return getattr(getattr(source, 'original', source), '_process', None) # PCMVolumeTransformer membungkus FFmpegPCMAudio
+
+def stop_current(vc):
+    # Stop yang disengaja (skip/replay/stop); tanpa tanda ini akhir lagu dini dianggap stream putus
+    source = current_track_source(vc)
+    if source: source.stop_requested = True
+    vc.stop()
+
+# --- Prefetch (Lookahead) Lagu Berikutnya ---
+def build_autoplay_query(player):
+    last_played_item = player.history
+    if isinstance(last_played_item, QueuedTrack): return f"{last_played_item.artist} {last_played_item.title} mix"
+    if re.match(r'http[s]?://', str(last_played_item)): # URL + kata kunci tetap dianggap URL oleh extract_data, bukan pencarian
+        return f"{player.history_label} related" if player.history_label else str(last_played_item)
+    return f"{str(last_played_item)} related"
+
+def is_valid_autoplay_query(query_autoplay):
+    return query_autoplay.strip().lower() not in ["mix", "related", " unknown artist - judul tidak diketahui mix"] # Hindari query kosong
+
+# --- Autoplay: kandidat dari mix YouTube, di-cache per seed ---
+AUTOPLAY_YDL_OPTS = {'quiet': True, 'no_warnings': True, 'extract_flat': 'in_playlist', 'playlistend': AUTOPLAY_BATCH, 'skip_download': True}
+
+def _ydl_extract_related(ydl_opts, url):
+    with load_youtube_dl().YoutubeDL(ydl_opts) as ydl:
+        data = ydl.extract_info(url, download=False)
+    return [{'id': e['id'], 'title': e.get('title') or e['id']} for e in data.get('entries') or [] if e and e.get('id')]
+
+def autoplay_url(candidate):
+    return f"https://www.youtube.com/watch?v={candidate['id']}"
+
+class AutoplayEngine:
+    def __init__(self, max_seeds):
+        self.max_seeds = max_seeds
+        self._pools = OrderedDict() # seed video id -> (expires_at, [kandidat])
+        self._inflight = {} # seed -> Task; satu fetch dibagi semua guild dengan seed yang sama
+        self._waiters = {} # seed -> guild yang perlu prefetch ulang setelah fetch selesai
+        self.fetches = self.hits = self.fallbacks = 0
+
+    def _cached(self, seed):
+        entry = self._pools.get(seed)
+        if entry is None: return None
+        if time.time() >= entry[0]: del self._pools[seed]; return None
+        self._pools.move_to_end(seed); return entry[1]
+
+    @staticmethod
+    def _pick(candidates, player):
+        recent = set(player.recent_ids)
+        return next((c for c in candidates if c['id'] not in recent), None)
+
+    def _seed(self, player):
+        # Terus ambil dari pool seed yang sama sampai habis, baru ganti seed ke lagu terakhir
+        seed = player.autoplay_seed
+        if seed:
+            candidates = self._cached(seed)
+            if candidates is None or self._pick(candidates, player): return seed
+        return player.recent_ids[-1] if player.recent_ids else None
+
+    def _fetch(self, seed, guild_id):
+        task = self._inflight.get(seed)
+        if task is None: task = self._inflight[seed] = spawn_task(self._load(seed, guild_id))
+        return task
+
+    async def _load(self, seed, guild_id):
+        try:
+            candidates = await extraction_pool.run(guild_id, _ydl_extract_related, AUTOPLAY_YDL_OPTS, f"https://www.youtube.com/watch?v={seed}&list=RD{seed}")
+            self.fetches += 1
+        except Exception as e: print(f"Gagal mengambil rekomendasi autoplay untuk {seed}: {e}"); candidates = []
+        finally: self._inflight.pop(seed, None)
+        self._pools[seed] = (time.time() + (AUTOPLAY_CACHE_TTL if candidates else 60), candidates) # Kegagalan di-cache sebentar saja
+        while len(self._pools) > self.max_seeds: self._pools.popitem(last=False)
+        for guild_id in self._waiters.pop(seed, ()): schedule_prefetch(guild_id)
+        return candidates
+
+    def peek(self, player):
+        # Kandidat berikutnya tanpa network; jika pool belum ada, ambil di background lalu prefetch ulang
+        seed = self._seed(player)
+        if not seed: return None
+        candidates = self._cached(seed)
+        if candidates is None:
+            self._waiters.setdefault(seed, set()).add(player.guild_id); self._fetch(seed, player.guild_id); return None
+        return self._pick(candidates, player)
+
+    async def take(self, player):
+        # None = tidak ada kandidat, pemanggil kembali ke pencarian "artis judul mix"
+        seed = self._seed(player)
+        if not seed: self.fallbacks += 1; return None
+        candidates = self._cached(seed)
+        if candidates is None: candidates = await asyncio.shield(self._fetch(seed, player.guild_id))
+        else: self.hits += 1
+        candidate = self._pick(candidates, player)
+        if not candidate: self.fallbacks += 1; return None
+        player.autoplay_seed = seed; player.recent_ids.append(candidate['id'])
+        return candidate
+
+    def forget(self, guild_id):
+        for waiters in self._waiters.values(): waiters.discard(guild_id)
+
+    def stats(self):
+        return {'seeds': len(self._pools), 'inflight': len(self._inflight), 'fetches': self.fetches, 'hits': self.hits, 'fallbacks': self.fallbacks}
+
+autoplay_engine = AutoplayEngine(AUTOPLAY_CACHE_SIZE)
+
+def upcoming_items(player, depth):
+    if player.queue: return player.queue[:depth]
+    if player.autoplay and player.recent_ids:
+        candidate = autoplay_engine.peek(player)
+        return [autoplay_url(candidate)] if candidate else []
+    if player.autoplay and player.history:
+        query_autoplay = build_autoplay_query(player)
+        if is_valid_autoplay_query(query_autoplay): return [query_autoplay]
+    return []
+
+async def _prefetch_one(guild_id, item_data_or_query):
+    try: return await YTDLSource.extract_data(item_data_or_query, stream=True, guild_id=guild_id)
+    except asyncio.CancelledError: raise
+    except ExtractionPaused: return None
+    except Exception as e: print(f"Prefetch gagal '{YTDLSource.query_of(item_data_or_query)}': {e}"); return None
+
+def schedule_prefetch(guild_id):
+    # Resolve beberapa lagu berikutnya di background; buang lookahead yang sudah tidak relevan
+    player = find_player(guild_id)
+    if PREFETCH_DEPTH <= 0 or not player: return
+    wanted = {}
+    for item in upcoming_items(player, PREFETCH_DEPTH): wanted.setdefault(YTDLSource.query_of(item), item)
+    tasks = player.prefetch
+    for query in [q for q in tasks if q not in wanted]: tasks.pop(query).cancel()
+    for query, item in wanted.items():
+        if query not in tasks: tasks[query] = bot.loop.create_task(_prefetch_one(guild_id, item))
+
+async def take_prefetched(guild_id, item_data_or_query, keep=False):
+    # Ambil hasil prefetch untuk item ini (menunggu jika masih berjalan); None jika tidak ada/kedaluwarsa. keep: task tetap tersimpan
+    player = find_player(guild_id)
+    task = (player.prefetch.get if keep else player.prefetch.pop)(YTDLSource.query_of(item_data_or_query), None) if player else None
+    if not task or task.cancelled(): return None
+    data = await (asyncio.shield(task) if keep else task)
+    if not data or time.monotonic() - data.get('_resolved_at', 0) > PREFETCH_MAX_AGE: return None
+    data['original_query_info'] = item_data_or_query
+    return data
+
+# --- Antrian Update Pesan per Channel (digabung & dibatasi laju) ---
+def channel_guild_id(channel):
+    guild = getattr(channel, 'guild', None)
+    return guild.id if guild else None
+
+class ChannelUpdates:
+    __slots__ = ('channel', 'pending', 'sent_at', 'worker')
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.pending = OrderedDict() # kunci -> operasi terbaru; operasi dengan kunci sama digabung
+        self.sent_at = deque(maxlen=CHANNEL_UPDATE_RATE) # Waktu request terakhir (token bucket)
+        self.worker = None
+
+class MessageUpdateQueue:
+    def __init__(self):
+        self._channels = {}
+        self._anchors = {} # guild_id -> [pesan Now Playing terakhir, tombol masih aktif?]
+        self.submitted = self.merged = self.in_place = self.requests = self.paced = 0; self.paced_wait = 0.0
+        self._sends = 0
+
+    def _submit(self, channel, key, op):
+        state = self._channels.get(channel.id)
+        if state is None: state = self._channels[channel.id] = ChannelUpdates(channel)
+        self.submitted += 1
+        if key in state.pending:
+            previous = state.pending[key]; self.merged += 1
+            if op[0] == 'edit': op = ('edit', op[1], {**previous[2], **op[2]})
+        state.pending[key] = op
+        if not state.worker: state.worker = spawn_task(self._drain(state))
+
+    def edit(self, message, **fields):
+        # Edit beruntun ke pesan yang sama jadi satu request
+        self._submit(message.channel, ('edit', message.id), ('edit', message, fields))
+
+    def send(self, channel, **fields):
+        # Pesan baru (error, antrian habis, skip) tidak digabung, tapi tetap antre di token bucket channel yang sama
+        self._sends += 1; self._submit(channel, ('send', self._sends), ('send', channel, fields))
+
+    def now_playing(self, player, channel, embed=None, view=None):
+        # State terbaru menang; embed None = tidak ada lagu aktif (lepas tombol dari pesan lama)
+        anchor = self._anchors.get(player.guild_id)
+        channel = channel or (anchor and anchor[0].channel)
+        if channel: self._submit(channel, ('np', player.guild_id), ('np', player, (embed, view)))
+
+    def forget(self, guild_id):
+        self._anchors.pop(guild_id, None)
+        for channel_id, state in list(self._channels.items()):
+            state.pending.pop(('np', guild_id), None)
+            if channel_guild_id(state.channel) == guild_id and not state.worker: del self._channels[channel_id] # Worker aktif melepasnya sendiri setelah antrian kosong
+
+    async def _pace(self, state):
+        if len(state.sent_at) < CHANNEL_UPDATE_RATE: return
+        wait = CHANNEL_UPDATE_PER - (time.monotonic() - state.sent_at[0])
+        if wait > 0: self.paced += 1; self.paced_wait += wait; await asyncio.sleep(wait) # Update baru selama menunggu ikut digabung
+
+    async def _request(self, state, make_request):
+        await self._pace(state)
+        state.sent_at.append(time.monotonic()); self.requests += 1
+        return await make_request()
+
+    async def _apply_now_playing(self, state, player, embed, view):
+        if players.get(player.guild_id) is not player: return # Pemutar sudah dilepas (stop)
+        anchor = self._anchors.get(player.guild_id)
+        if embed is None:
+            if anchor and anchor[1]: anchor[1] = False; await self._request(state, lambda: anchor[0].edit(view=None))
+            return
+        if anchor and anchor[0].channel.id == state.channel.id and state.channel.last_message_id == anchor[0].id:
+            try: # Pesan lama masih paling bawah: cukup edit, tidak perlu hapus tombol + kirim baru
+                await self._request(state, lambda: anchor[0].edit(embed=embed, view=view))
+                self.in_place += 1; player.now_playing_message = anchor[0]; anchor[1] = True; return
+            except discord.NotFound: pass
+        if anchor and anchor[1]:
+            try: await self._request(state, lambda: anchor[0].edit(view=None))
+            except discord.HTTPException: pass
+        started = time.perf_counter()
+        message = await self._request(state, lambda: state.channel.send(embed=embed, view=view))
+        metrics.observe('embed_send', time.perf_counter() - started)
+        self._anchors[player.guild_id] = [message, True]
+        if players.get(player.guild_id) is player: player.now_playing_message = message
+
+    async def _drain(self, state):
         try:
-            with youtube_dl.YoutubeDL(final_ydl_opts) as ydl: data = await loop.run_in_executor(None, lambda: ydl.extract_info(query_to_search, download=not stream))
-        except Exception as e: print(f"Error yt-dlp: {e}"); raise 
-        if 'entries' in data: data = data['entries'][0]
-        data['original_query_info'] = original_info_for_player
-        filename = data['url'] if stream else ydl.prepare_filename(data)
-        return cls(discord.FFmpegPCMAudio(filename, **FFMPEG_OPTS), data=data)
+            while state.pending:
+                await self._pace(state)
+                _, (kind, target, payload) = state.pending.popitem(last=False)
+                try:
+                    if kind == 'edit': await self._request(state, lambda: target.edit(**payload))
+                    elif kind == 'send': await self._request(state, lambda: target.send(**payload))
+                    else: await self._apply_now_playing(state, target, *payload)
+                except discord.HTTPException as e: print(f"Gagal update pesan di channel {state.channel.id}: {e}")
+        finally:
+            state.worker = None
+            if channel_guild_id(state.channel) not in players and self._channels.get(state.channel.id) is state: del self._channels[state.channel.id]
+
+    def stats(self):
+        saved = self.merged + self.in_place
+        return {'channels': len(self._channels), 'pending': sum(len(s.pending) for s in self._channels.values()), 'submitted': self.submitted, 'merged': self.merged, 'in_place': self.in_place,
+                'requests': self.requests, 'paced': self.paced, 'paced_wait': round(self.paced_wait, 2), 'wait_avoided_est': round(saved * CHANNEL_UPDATE_PER / CHANNEL_UPDATE_RATE, 2)}
+
+message_updates = MessageUpdateQueue()
 
 # --- Music Player View (Tombol-Tombol) ---
 class MusicPlayerView(discord.ui.View):
@@ -153,14 +1233,15 @@ class MusicPlayerView(discord.ui.View):
         
         autoplay_button = discord.utils.get(self.children, custom_id="autoplay")
         if autoplay_button:
-            if autoplay_enabled.get(self.guild_id, False): autoplay_button.style, autoplay_button.label = discord.ButtonStyle.green, "Autoplay: ON"
+            player = find_player(self.guild_id)
+            if player and player.autoplay: autoplay_button.style, autoplay_button.label = discord.ButtonStyle.green, "Autoplay: ON"
             else: autoplay_button.style, autoplay_button.label = discord.ButtonStyle.grey, "Autoplay: OFF"
         
         replay_button = discord.utils.get(self.children, custom_id="replay")
         skip_button = discord.utils.get(self.children, custom_id="skip")
         stop_button = discord.utils.get(self.children, custom_id="stop_playback")
 
-        if replay_button: replay_button.disabled = not (is_playing_or_paused and song_history.get(self.guild_id))
+        if replay_button: replay_button.disabled = not (is_playing_or_paused and getattr(find_player(self.guild_id), 'history', None))
         if skip_button: skip_button.disabled = not is_playing_or_paused
         if stop_button: stop_button.disabled = not vc
 
@@ -175,21 +1256,20 @@ class MusicPlayerView(discord.ui.View):
 
     @discord.ui.button(label="Replay", style=discord.ButtonStyle.secondary, emoji="⏪", custom_id="replay", row=0)
     async def replay_button(self, interaction: discord.Interaction, button: discord.ui.Button):
-        guild_id = interaction.guild_id; vc = interaction.guild.voice_client
-        last_song_data = song_history.get(guild_id)
+        guild_id = interaction.guild_id; vc = interaction.guild.voice_client; player = get_player(guild_id)
+        last_song_data = player.history
         if vc and last_song_data:
-            current_q_item_for_history = current_song.get(guild_id, {}).get('original_query_info')
+            current_q_item_for_history = (player.current_song or {}).get('original_query_info')
             if vc.is_playing() and current_q_item_for_history:
-                 music_queue.setdefault(guild_id, []).insert(0, current_q_item_for_history)
-            music_queue.setdefault(guild_id, []).insert(0, last_song_data)
-            if vc.is_playing() or vc.is_paused(): vc.stop()
+                 player.queue.appendleft(current_q_item_for_history)
+            player.queue.appendleft(last_song_data)
+            schedule_prefetch(guild_id) # Lookahead lama tetap dipakai jika masih relevan
+            if vc.is_playing() or vc.is_paused(): stop_current(vc)
             else: await play_next(interaction)
             await interaction.response.send_message("⏪ Memutar ulang lagu...", ephemeral=True, delete_after=5)
         else: await interaction.response.send_message("Tidak ada lagu untuk diputar ulang.", ephemeral=True, delete_after=10)
         self.update_buttons_state()
-        if interaction.message: 
-            try: await interaction.message.edit(view=self)
-            except discord.NotFound: pass # Abaikan jika pesan sudah dihapus
+        if interaction.message: message_updates.edit(interaction.message, view=self)
 
     @discord.ui.button(label="Pause", style=discord.ButtonStyle.primary, emoji="⏸️", custom_id="pause_resume", row=0)
     async def pause_resume_button(self, interaction: discord.Interaction, button: discord.ui.Button):
@@ -206,30 +1286,27 @@ class MusicPlayerView(discord.ui.View):
         vc = interaction.guild.voice_client
         if not vc or not (vc.is_playing() or vc.is_paused()):
             return await interaction.response.send_message("Tidak ada musik untuk dilewati.", ephemeral=True, delete_after=10)
-        skipped_song_title = current_song.get(interaction.guild_id, {}).get('title', 'Lagu saat ini')
+        skipped_song_title = current_song_info(interaction.guild_id).get('title', 'Lagu saat ini')
         await interaction.response.send_message(f"⏭️ **{skipped_song_title}** dilewati!", ephemeral=False, delete_after=10)
-        vc.stop() 
+        stop_current(vc) 
 
     @discord.ui.button(label="Stop", style=discord.ButtonStyle.danger, emoji="⏹️", custom_id="stop_playback", row=0)
     async def stop_button(self, interaction: discord.Interaction, button: discord.ui.Button):
-        guild_id = interaction.guild_id; vc = interaction.guild.voice_client
+        vc = interaction.guild.voice_client
         if not vc: return await interaction.response.send_message("Bot tidak di voice channel.", ephemeral=True, delete_after=10)
-        if guild_id in music_queue: music_queue[guild_id].clear()
-        current_song.pop(guild_id, None); song_history.pop(guild_id, None); autoplay_enabled.pop(guild_id, None)
-        if vc.is_playing() or vc.is_paused(): vc.stop()
-        await vc.disconnect()
+        await teardown_guild(interaction.guild, 'stop')
         embed_stopped = discord.Embed(title="⏹️ Pemutaran Dihentikan", description="Bot keluar dari voice channel. Antrian dibersihkan.", color=discord.Color.red()); embed_stopped.set_footer(text=WATERMARK_TEXT)
         try: await interaction.message.edit(embed=embed_stopped, view=None) 
         except discord.NotFound: await interaction.channel.send(embed=embed_stopped) # Kirim baru jika pesan asli hilang
-        if guild_id in now_playing_message: now_playing_message.pop(guild_id, None)
         self.stop()
 
     @discord.ui.button(label="Autoplay: OFF", style=discord.ButtonStyle.grey, emoji="🔁", custom_id="autoplay", row=0)
     async def autoplay_button(self, interaction: discord.Interaction, button: discord.ui.Button):
-        guild_id = interaction.guild_id
-        autoplay_enabled[guild_id] = not autoplay_enabled.get(guild_id, False)
+        guild_id = interaction.guild_id; player = get_player(guild_id)
+        player.autoplay = not player.autoplay
+        schedule_prefetch(guild_id)
         self.update_buttons_state(); await interaction.response.edit_message(view=self)
-        message_content = "✅ Autoplay diaktifkan!" if autoplay_enabled[guild_id] else "❌ Autoplay dinonaktifkan!"
+        message_content = "✅ Autoplay diaktifkan!" if player.autoplay else "❌ Autoplay dinonaktifkan!"
         try: # Menggunakan followup jika interaksi sudah direspons oleh edit_message
             await interaction.followup.send(message_content, ephemeral=True)
         except discord.HTTPException: # Jika followup gagal (misal karena sudah direspons dengan cara lain atau terlalu lama)
@@ -237,81 +1314,261 @@ class MusicPlayerView(discord.ui.View):
 
 
 # --- Fungsi Helper & Event ---
+TRANSITION_MAX_FAILURES = int(os.getenv('TRANSITION_MAX_FAILURES', '3')) # Gagal putar beruntun sebelum antrian dijeda
+background_tasks = set() # Referensi kuat untuk task fire-and-forget
+
+def spawn_task(coro):
+    task = bot.loop.create_task(coro)
+    background_tasks.add(task); task.add_done_callback(background_tasks.discard)
+    return task
+
+async def cleanup_in_thread(source):
+    # Kill ffmpeg bisa menunggu proses keluar; jalankan di thread & catat kegagalannya
+    try: await asyncio.to_thread(source.cleanup)
+    except Exception as e: print(f"Gagal membersihkan source '{getattr(source, 'title', '?')}': {e}")
+
+def unpack_ctx(ctx_or_interaction):
+    user = ctx_or_interaction.user if isinstance(ctx_or_interaction, discord.Interaction) else ctx_or_interaction.author
+    return ctx_or_interaction.guild, ctx_or_interaction.channel, user.id
+
+class TransitionScheduler:
+    # Satu per guild: event "lagu selesai" dari thread audio diterima tanpa blocking, transisi dijalankan berurutan
+    def __init__(self, guild_id):
+        self.guild_id = guild_id
+        self.lock = asyncio.Lock()
+        self.generation = 0 # Naik setiap lagu mulai; callback lagu lama diabaikan
+
+    def after_callback(self, ctx_or_interaction, generation, source=None):
+        def _after(error): # Thread audio discord.py: cukup jadwalkan, jangan tunggu play_next
+            bot.loop.call_soon_threadsafe(self._on_track_end, ctx_or_interaction, generation, error, source)
+        return _after
+
+    def handoff_callback(self, ctx_or_interaction, wrapper):
+        def _handoff(previous, prepared): # Thread audio: lagu berikutnya sudah tersambung, sisanya dikerjakan di event loop
+            bot.loop.call_soon_threadsafe(self._on_handoff, ctx_or_interaction, wrapper, previous, prepared)
+        return _handoff
+
+    def _on_handoff(self, ctx_or_interaction, wrapper, previous, prepared):
+        self.generation += 1; wrapper.generation = self.generation # Langsung di sini: callback akhir lagu yang menyusul harus melihat generasi baru
+        spawn_task(self.complete_handoff(ctx_or_interaction, wrapper, previous, prepared))
+
+    async def complete_handoff(self, ctx_or_interaction, wrapper, previous, prepared):
+        spawn_task(cleanup_in_thread(previous)) # Tidak dibersihkan player discord.py karena tidak pernah jadi vc.source
+        async with self.lock:
+            player_state = find_player(self.guild_id)
+            if not player_state: return
+            if player_state.queue.peek() is prepared.item: player_state.queue.popleft(); player_state.autoplay_seed = None
+            gapless_stats['handoffs'] += 1; player_state.now_playing_message = None
+            announce_track(ctx_or_interaction, player_state, prepared.item, prepared.data, prepared.source)
+            schedule_gapless(player_state, wrapper)
+
+    def _on_track_end(self, ctx_or_interaction, generation, error, source=None):
+        if isinstance(source, GaplessSource): generation, source = source.generation, source.track
+        if generation == self.generation: spawn_task(check_after_play(ctx_or_interaction, error, generation, source))
+
+    async def recover(self, ctx_or_interaction, generation, source):
+        # Lanjutkan lagu yang sama dari posisi terakhir; True jika berhasil (transisi ke lagu berikutnya dibatalkan)
+        async with self.lock:
+            if generation != self.generation: return True
+            vc = ctx_or_interaction.guild.voice_client
+            if not vc or not vc.is_connected() or vc.is_playing() or vc.is_paused(): return False
+            started = time.perf_counter(); position = source.position; stream_recovery_stats['attempts'] += 1
+            print(f"Guild {self.guild_id}: stream '{source.title}' putus di {position:.0f}s, mencoba melanjutkan ({source.recoveries + 1}/{STREAM_RECOVERY_MAX}).")
+            try:
+                resolve_cache.invalidate_url(source.data.get('url')) # Entri lain yang URL-nya masih segar tetap boleh dipakai
+                data = await YTDLSource.extract_data(source.data.get('webpage_url') or source.original_query_info, stream=True, guild_id=self.guild_id)
+                data['original_query_info'] = source.original_query_info
+                resumed = create_audio_source(data, position); resumed.recoveries = source.recoveries + 1
+                player = find_player(self.guild_id)
+                if player: player.sources.add(resumed)
+                play_track(ctx_or_interaction, self, vc, resumed)
+            except Exception as e:
+                stream_recovery_stats['failed'] += 1; print(f"Pemulihan stream gagal: {e}")
+                player = find_player(self.guild_id)
+                if isinstance(e, ExtractionPaused) and player: # Breaker terbuka: lagu ini ditahan di depan antrian & dilanjutkan dari posisinya nanti
+                    item = source.original_query_info or source.data.get('webpage_url')
+                    player.queue.appendleft(item); player.seek_on_start = (item, position)
+                return False
+            stream_recovery_stats['recovered'] += 1; metrics.observe('stream_recovery', time.perf_counter() - started) # Histogram latensi: /metrics & !!stats
+            return True
+
+    async def advance(self, ctx_or_interaction, *, expected_generation=None, only_if_idle=False):
+        async with self.lock:
+            if expected_generation is not None and expected_generation != self.generation: return # Sudah ditangani transisi lain
+            vc = ctx_or_interaction.guild.voice_client
+            if only_if_idle and vc and (vc.is_playing() or vc.is_paused()): return
+            for _ in range(TRANSITION_MAX_FAILURES):
+                if await start_next_track(ctx_or_interaction, self): return
+            text_channel = ctx_or_interaction.channel
+            player = find_player(self.guild_id)
+            if player: player.halted = True
+            print(f"Guild {self.guild_id}: {TRANSITION_MAX_FAILURES} lagu gagal beruntun, antrian dijeda.")
+            if text_channel:
+                embed_halt = discord.Embed(title="⛔ Antrian Dijeda", description=f"{TRANSITION_MAX_FAILURES} lagu gagal diputar berturut-turut. Sisa antrian tetap tersimpan, gunakan `{BOT_PREFIX}resume` untuk mencoba lagi.", color=discord.Color.red()); embed_halt.set_footer(text=WATERMARK_TEXT)
+                message_updates.send(text_channel, embed=embed_halt)
+
+stream_recovery_stats = {'attempts': 0, 'recovered': 0, 'failed': 0}
+
+def needs_stream_recovery(source, error):
+    # ffmpeg keluar sebelum lagu habis tanpa diminta (URL kedaluwarsa / koneksi putus)
+    if not isinstance(source, TrackInfoMixin) or source.stop_requested or source.data.get('_local'): return False
+    if source.recoveries >= STREAM_RECOVERY_MAX or not source.duration: return False # Live stream tanpa durasi tidak bisa di-seek
+    return bool(error) or source.position < source.duration - STREAM_RECOVERY_TAIL
+
+def current_song_info(guild_id):
+    player = find_player(guild_id)
+    return (player and player.current_song) or {}
+
 async def play_next(ctx_or_interaction):
-    if isinstance(ctx_or_interaction, discord.Interaction):
-        guild = ctx_or_interaction.guild; text_channel = ctx_or_interaction.channel
-        original_user_id = ctx_or_interaction.user.id
-    else: 
-        guild = ctx_or_interaction.guild; text_channel = ctx_or_interaction.channel
-        original_user_id = ctx_or_interaction.author.id
-    if not guild: return
-    guild_id = guild.id; vc = guild.voice_client
-
-    if now_playing_message.get(guild_id):
-        try: await now_playing_message[guild_id].edit(view=None)
-        except: pass
-        now_playing_message.pop(guild_id, None)
-    if not vc: current_song.pop(guild_id, None); return
+    # Mulai lagu berikutnya jika bot sedang diam (aman dipanggil dari perintah mana pun)
+    if not ctx_or_interaction.guild: return
+    await get_player(ctx_or_interaction.guild.id).scheduler.advance(ctx_or_interaction, only_if_idle=True)
+
+async def start_next_track(ctx_or_interaction, scheduler):
+    # Return False hanya jika lagu gagal diputar (transisi boleh mencoba item berikutnya)
+    guild, text_channel, original_user_id = unpack_ctx(ctx_or_interaction)
+    guild_id = guild.id; vc = guild.voice_client; player_state = get_player(guild_id)
+
+    player_state.now_playing_message = None
+    message_updates.now_playing(player_state, text_channel) # Lepas tombol lama; digabung dengan Now Playing berikutnya jika masih antre
+    if not vc: player_state.current_song = None; return True
+    transition_started = time.perf_counter()
 
     item_to_play_data = None
-    if music_queue.get(guild_id):
-        item_to_play_data = music_queue[guild_id].pop(0)
-    elif autoplay_enabled.get(guild_id, False) and song_history.get(guild_id):
-        last_played_item = song_history.get(guild_id)
-        query_autoplay = f"{last_played_item.get('artist','')} {last_played_item.get('title','')} mix" if isinstance(last_played_item, dict) else f"{str(last_played_item)} related"
-        if query_autoplay.strip().lower() not in ["mix", "related", " unknown artist - judul tidak diketahui mix"]: # Hindari query kosong
-            embed_auto = discord.Embed(title="Автовоспроизведение 🔁", description=f"Mencari terkait: **{query_autoplay.replace(' mix','').replace(' related','')}**...", color=discord.Color.blue()); embed_auto.set_footer(text=WATERMARK_TEXT)
-            if text_channel: await text_channel.send(embed=embed_auto, delete_after=10)
+    if player_state.queue:
+        item_to_play_data = player_state.queue.popleft(); player_state.autoplay_seed = None # Lagu pilihan user jadi seed autoplay berikutnya
+    elif player_state.autoplay and player_state.history:
+        candidate = await autoplay_engine.take(player_state)
+        query_autoplay = autoplay_url(candidate) if candidate else build_autoplay_query(player_state)
+        if candidate or is_valid_autoplay_query(query_autoplay):
+            description = f"Berikutnya: **{candidate['title']}**" if candidate else f"Mencari terkait: **{query_autoplay.replace(' mix','').replace(' related','')}**..."
+            embed_auto = discord.Embed(title="Автовоспроизведение 🔁", description=description, color=discord.Color.blue()); embed_auto.set_footer(text=WATERMARK_TEXT)
+            if text_channel: message_updates.send(text_channel, embed=embed_auto, delete_after=10)
             item_to_play_data = query_autoplay
         else:
-             current_song.pop(guild_id, None)
+             player_state.current_song = None
              if text_channel: 
                  embed_q_empty = discord.Embed(title="Antrian Habis", description="Autoplay gagal mencari acuan lagu.", color=discord.Color.gold()); embed_q_empty.set_footer(text=WATERMARK_TEXT)
-                 await text_channel.send(embed=embed_q_empty)
-             return
+                 message_updates.send(text_channel, embed=embed_q_empty)
+             return True
     else:
-        current_song.pop(guild_id, None)
+        player_state.current_song = None
         embed_q_empty = discord.Embed(title="Antrian Habis", description="Tidak ada lagi lagu di antrian.", color=discord.Color.gold()); embed_q_empty.set_footer(text=WATERMARK_TEXT)
-        if text_channel: await text_channel.send(embed=embed_q_empty)
-        return
+        if text_channel: message_updates.send(text_channel, embed=embed_q_empty)
+        return True
 
-    if not item_to_play_data: return
+    if not item_to_play_data: return True
+    start_at = 0
+    if player_state.seek_on_start and player_state.seek_on_start[0] is item_to_play_data: start_at = player_state.seek_on_start[1]
+    player_state.seek_on_start = None
 
-    display_title, original_url_for_display, item_thumbnail = "Lagu Diproses...", "", None
-    if isinstance(item_to_play_data, dict):
-        display_title = f"{item_to_play_data.get('artist','')} - {item_to_play_data.get('title','Judul Tidak Ada')}".strip(" - ")
-        if item_to_play_data.get('spotify_url'): original_url_for_display = f" ([Spotify]({item_to_play_data['spotify_url']}))"
-        item_thumbnail = item_to_play_data.get('thumbnail')
-    
     try:
-        player = await YTDLSource.from_url(item_to_play_data, loop=bot.loop, stream=True)
-        if display_title == "Lagu Diproses...": display_title = player.title
-        if not original_url_for_display and player.url: original_url_for_display = f" ([Link]({player.url}))"
-        if not item_thumbnail: item_thumbnail = player.thumbnail
-
-        vc.play(player, after=lambda e: asyncio.run_coroutine_threadsafe(check_after_play(ctx_or_interaction, e), bot.loop).result())
-        current_song[guild_id] = {"title": display_title, "thumbnail": item_thumbnail, "url_display": original_url_for_display, "duration": player.duration, "uploader": player.uploader, "original_query_info": player.original_query_info}
-        song_history[guild_id] = player.original_query_info
-
-        embed = discord.Embed(title="🎧 Memutar Sekarang", description=f"**[{display_title}]({player.url or '#'})**{original_url_for_display}", color=discord.Color.green())
-        if item_thumbnail: embed.set_thumbnail(url=item_thumbnail)
-        if player.duration: embed.add_field(name="Durasi", value=f"{int(player.duration//60)}:{int(player.duration%60):02d}", inline=True)
-        if player.uploader: embed.add_field(name="Oleh", value=player.uploader, inline=True)
-        embed.set_footer(text=WATERMARK_TEXT)
-        
-        view = MusicPlayerView(ctx_bot=bot, guild_id=guild_id, original_interaction_user_id=original_user_id)
-        if text_channel: 
-            msg = await text_channel.send(embed=embed, view=view)
-            now_playing_message[guild_id] = msg
+        data = await take_prefetched(guild_id, item_to_play_data) or await YTDLSource.extract_data(item_to_play_data, stream=True, guild_id=guild_id)
+        player = create_audio_source(data, start_at); player_state.sources.add(player)
+        play_track(ctx_or_interaction, scheduler, vc, player)
+        metrics.observe('track_start', player.play_requested_at - transition_started)
+        announce_track(ctx_or_interaction, player_state, item_to_play_data, data, player)
+        return True
     except Exception as e:
-        err_title = display_title if display_title!="Lagu Diproses..." else str(item_to_play_data)
+        if not vc.is_playing() and (isinstance(e, ExtractionPaused) or extraction_breaker.state != 'closed'):
+            # Gangguan sistemik (throttling/bot check): kembalikan item ke depan & jeda, jangan habiskan antrian
+            player_state.queue.appendleft(item_to_play_data); player_state.current_song = None
+            if start_at: player_state.seek_on_start = (item_to_play_data, start_at)
+            await pause_for_breaker(ctx_or_interaction, player_state, text_channel)
+            return True
+        err_title = (item_to_play_data.label or "Judul Tidak Ada") if isinstance(item_to_play_data, QueuedTrack) else str(item_to_play_data)
         print(f"Gagal putar '{err_title}': {e}")
         if text_channel:
             embed_err = discord.Embed(title="⚠️ Gagal Putar", description=f"**{err_title}**\nError: `{type(e).__name__}`", color=discord.Color.red()); embed_err.set_footer(text=WATERMARK_TEXT)
-            await text_channel.send(embed=embed_err)
-        await play_next(ctx_or_interaction)
+            message_updates.send(text_channel, embed=embed_err)
+        return vc.is_playing() # Lagu sudah jalan (mis. hanya embed yang gagal) -> jangan lanjut ke item berikutnya
+
+def play_track(ctx_or_interaction, scheduler, vc, source):
+    # Generasi baru + vc.play; mode gapless membungkus source agar lagu berikutnya bisa disambung tanpa jeda
+    generation = scheduler.generation + 1; source.play_requested_at = time.perf_counter()
+    player_state = find_player(scheduler.guild_id)
+    audio = GaplessSource(source, generation, player_state.queue) if GAPLESS_ENABLED and player_state else source
+    if audio is not source: audio.on_handoff = scheduler.handoff_callback(ctx_or_interaction, audio)
+    vc.play(audio, after=scheduler.after_callback(ctx_or_interaction, generation, audio))
+    scheduler.generation = generation # Baru dinaikkan setelah vc.play berhasil: jika gagal, advance dengan generasi lama tetap berjalan
+    if audio is not source: schedule_gapless(player_state, audio)
+
+def announce_track(ctx_or_interaction, player_state, item, data, source):
+    # Catat lagu yang baru mulai (history, autoplay, cache, prefetch) & kirim embed Now Playing
+    guild, text_channel, original_user_id = unpack_ctx(ctx_or_interaction)
+    display_title, original_url_for_display, item_thumbnail = source.title, "", None
+    if isinstance(item, QueuedTrack):
+        display_title = item.label or "Judul Tidak Ada"
+        if item.spotify_url: original_url_for_display = f" ([Spotify]({item.spotify_url}))"
+        item_thumbnail = item.thumbnail
+    if not original_url_for_display and source.url: original_url_for_display = f" ([Link]({source.url}))"
+    if not item_thumbnail: item_thumbnail = source.thumbnail
+
+    player_state.current_song = {"title": display_title, "thumbnail": item_thumbnail, "url_display": original_url_for_display, "duration": source.duration, "uploader": source.uploader, "original_query_info": source.original_query_info}
+    player_state.history = source.original_query_info
+    player_state.history_label = ' '.join(filter(None, (data.get('uploader'), data.get('title')))) or None
+    if text_channel: player_state.text_channel_id = text_channel.id
+    player_state.breaker_paused = player_state.halted = False
+    if data.get('id') and (not player_state.recent_ids or player_state.recent_ids[-1] != data['id']): player_state.recent_ids.append(data['id'])
+    if audio_cache: audio_cache.record_play(YTDLSource.query_of(item), data)
+    schedule_prefetch(guild.id)
+
+    embed = discord.Embed(title="🎧 Memutar Sekarang", description=f"**[{display_title}]({source.url or '#'})**{original_url_for_display}", color=discord.Color.green())
+    if item_thumbnail: embed.set_thumbnail(url=item_thumbnail)
+    if source.duration: embed.add_field(name="Durasi", value=f"{int(source.duration//60)}:{int(source.duration%60):02d}", inline=True)
+    if source.uploader: embed.add_field(name="Oleh", value=source.uploader, inline=True)
+    embed.set_footer(text=WATERMARK_TEXT)
+    
+    view = MusicPlayerView(ctx_bot=bot, guild_id=guild.id, original_interaction_user_id=original_user_id)
+    message_updates.now_playing(player_state, text_channel, embed, view)
+
+def schedule_gapless(player, wrapper):
+    if player.gapless_task: player.gapless_task.cancel()
+    player.gapless_task = spawn_task(prepare_gapless(player, wrapper, wrapper.track)) if wrapper.track.duration else None # Live stream: tidak ada "akhir lagu"
+
+async def prepare_gapless(player, wrapper, track):
+    # Menjelang akhir lagu: resolve (biasanya sudah di-prefetch), spawn ffmpeg lagu berikutnya & isi buffer awalnya
+    while not wrapper.closed and wrapper.track is track:
+        remaining = track.duration - track.position
+        if remaining <= GAPLESS_LEAD: break
+        await asyncio.sleep(min(remaining - GAPLESS_LEAD, 5)) # Dicek ulang berkala: pause menggeser akhir lagu
+    else: return
+    item = player.queue.peek() # Autoplay tetap lewat transisi biasa: kandidatnya baru dipilih saat lagu habis
+    if item is None: return
+    source = None
+    try:
+        data = await take_prefetched(player.guild_id, item, keep=True) or await YTDLSource.extract_data(item, stream=True, guild_id=player.guild_id)
+        if wrapper.closed or wrapper.track is not track or player.queue.peek() is not item: return
+        data['original_query_info'] = item
+        source = create_audio_source(data); player.sources.add(source)
+        prepared = PreparedTrack(item, data, source)
+        await bot.loop.run_in_executor(None, prepared.fill, int(GAPLESS_BUFFER * 50)) # 50 frame 20 ms per detik
+        if wrapper.offer(prepared): gapless_stats['prepared'] += 1; source = None
+    except asyncio.CancelledError: raise
+    except ExtractionPaused: pass
+    except Exception as e: gapless_stats['failed'] += 1; print(f"Gapless: gagal menyiapkan '{YTDLSource.query_of(item)}': {e}")
+    finally:
+        if source: source.cleanup() # Tidak terpakai (lagu sudah berganti/dibatalkan)
+
+async def pause_for_breaker(ctx_or_interaction, player, text_channel):
+    delay = extraction_breaker.retry_after() + random.uniform(0, 3) # Sebar waktu lanjut antar guild
+    if player.resume_task and not player.resume_task.done(): return
+    player.resume_task = spawn_task(resume_after_breaker(ctx_or_interaction, player, delay))
+    if player.breaker_paused: return # Sudah diberi tahu; ini percobaan ulang yang masih ditolak
+    player.breaker_paused = True
+    print(f"Guild {player.guild_id}: antrian dijeda {delay:.0f} detik (circuit breaker ekstraksi).")
+    if text_channel:
+        embed_pause = discord.Embed(title="⏸️ Antrian Dijeda Sementara", description=f"YouTube sedang membatasi permintaan. {len(player.queue)} lagu tetap di antrian dan dilanjutkan otomatis dalam ~{delay:.0f} detik.", color=discord.Color.orange()); embed_pause.set_footer(text=WATERMARK_TEXT)
+        message_updates.send(text_channel, embed=embed_pause)
+
+async def resume_after_breaker(ctx_or_interaction, player, delay):
+    await asyncio.sleep(delay)
+    player.resume_task = None
+    if players.get(player.guild_id) is player: await player.scheduler.advance(ctx_or_interaction, only_if_idle=True)
 
-async def check_after_play(ctx_or_interaction, error):
+async def check_after_play(ctx_or_interaction, error, generation, source=None):
+    player_state = find_player(ctx_or_interaction.guild.id)
+    if player_state and needs_stream_recovery(source, error) and await player_state.scheduler.recover(ctx_or_interaction, generation, source): return
     channel_to_send = None
     if isinstance(ctx_or_interaction, discord.Interaction): channel_to_send = ctx_or_interaction.channel
     elif hasattr(ctx_or_interaction, 'channel'): channel_to_send = ctx_or_interaction.channel
@@ -319,40 +1576,437 @@ async def check_after_play(ctx_or_interaction, error):
         print(f'Error setelah lagu: {error}')
         if channel_to_send:
             embed_err_after = discord.Embed(title="⚠️ Error Pemutaran", description=f"Terjadi error saat lagu selesai: `{error}`.", color=discord.Color.orange()); embed_err_after.set_footer(text=WATERMARK_TEXT)
-            await channel_to_send.send(embed=embed_err_after)
-    await play_next(ctx_or_interaction)
+            message_updates.send(channel_to_send, embed=embed_err_after)
+    player_state = find_player(ctx_or_interaction.guild.id)
+    if player_state: await player_state.scheduler.advance(ctx_or_interaction, expected_generation=generation)
+
+# --- Persistensi State Pemutar (SQLite, write-behind) ---
+def encode_queue_item(item):
+    return [item.title, item.artist, item.spotify_url, item.thumbnail, item._query, item.duration] if isinstance(item, QueuedTrack) else item
+
+def decode_queue_item(raw):
+    return QueuedTrack(*raw) if isinstance(raw, list) else raw # Snapshot lama (tanpa durasi) tetap terbaca
+
+class PlayerStateStore:
+    def __init__(self, path):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='statedb') # Satu thread = satu koneksi SQLite
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL'); self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS player_state (guild_id INTEGER PRIMARY KEY, queue TEXT NOT NULL, meta TEXT NOT NULL, updated_at REAL NOT NULL)')
+        self._conn.commit()
+        self.pending_guilds = {row[0] for row in self._conn.execute('SELECT guild_id FROM player_state')} # Dipulihkan saat guild tersedia
+        self._saved = {} # guild_id -> (queue.version, meta) terakhir yang ditulis
+        self._forgotten = set()
+        self.flushes = self.queue_writes = self.meta_writes = self.restored = 0
+        self.flusher = None; self.closed = False
+
+    def forget(self, guild_id):
+        self._saved.pop(guild_id, None); self.pending_guilds.discard(guild_id); self._forgotten.add(guild_id)
+
+    async def load(self, guild_id):
+        def _load():
+            row = self._conn.execute('SELECT queue, meta FROM player_state WHERE guild_id = ?', (guild_id,)).fetchone()
+            return (list(map(decode_queue_item, json.loads(row[0]))), json.loads(row[1])) if row else None
+        return await asyncio.get_running_loop().run_in_executor(self._executor, _load)
+
+    def _write(self, queue_rows, meta_rows, deletes):
+        now = time.time()
+        with self._conn:
+            self._conn.executemany('INSERT INTO player_state (guild_id, queue, meta, updated_at) VALUES (?, ?, ?, ?) ON CONFLICT(guild_id) DO UPDATE SET queue = excluded.queue, meta = excluded.meta, updated_at = excluded.updated_at',
+                                   [(gid, json.dumps([encode_queue_item(i) for i in items]), json.dumps(meta), now) for gid, items, meta in queue_rows])
+            self._conn.executemany('UPDATE player_state SET meta = ?, updated_at = ? WHERE guild_id = ?', [(json.dumps(meta), now, gid) for gid, meta in meta_rows])
+            self._conn.executemany('DELETE FROM player_state WHERE guild_id = ?', [(gid,) for gid in deletes])
+
+    async def flush(self):
+        # Snapshot murah di event loop (hanya salin referensi); serialisasi & tulis di thread DB
+        queue_rows, meta_rows, saved = [], [], {}
+        for guild_id, player in list(players.items()):
+            if guild_id in self.pending_guilds: continue # Belum dipulihkan, jangan ditimpa
+            meta = snapshot_player_meta(player); last = self._saved.get(guild_id)
+            if last is None or last[0] != player.queue.version: queue_rows.append((guild_id, list(player.queue), meta))
+            elif last[1] != meta: meta_rows.append((guild_id, meta))
+            else: continue
+            saved[guild_id] = (player.queue.version, meta)
+        deletes = [gid for gid in self._forgotten if gid not in players]; self._forgotten.clear()
+        if not (queue_rows or meta_rows or deletes): return
+        try: await asyncio.get_running_loop().run_in_executor(self._executor, self._write, queue_rows, meta_rows, deletes)
+        except BaseException: self._forgotten.update(deletes); raise # Commit gagal: semuanya ditulis ulang di flush berikutnya
+        self._saved.update((gid, v) for gid, v in saved.items() if gid not in self._forgotten) # Guild yang di-stop selama tulis tidak ditandai tersimpan
+        self.flushes += 1; self.queue_writes += len(queue_rows); self.meta_writes += len(meta_rows)
+
+    async def run_flusher(self):
+        while True:
+            await asyncio.sleep(STATE_FLUSH_INTERVAL)
+            try: await self.flush()
+            except Exception as e: print(f"Gagal menyimpan state pemutar: {e}")
+
+    async def close(self):
+        # Flush terakhir saat shutdown, lalu tutup koneksi di thread DB setelah tulisan yang masih antre
+        if self.closed: return
+        self.closed = True
+        if self.flusher: self.flusher.cancel(); self.flusher = None
+        try: await self.flush()
+        except Exception as e: print(f"Gagal menyimpan state pemutar saat shutdown: {e}")
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._conn.close)
+        self._executor.shutdown(wait=False)
+
+    def stats(self):
+        return {'pending_restore': len(self.pending_guilds), 'flushes': self.flushes, 'queue_writes': self.queue_writes, 'meta_writes': self.meta_writes, 'restored': self.restored}
+
+def snapshot_player_meta(player):
+    guild = bot.get_guild(player.guild_id); vc = guild.voice_client if guild else None
+    source = current_track_source(vc); current = None
+    if player.current_song and source:
+        current = {'item': encode_queue_item(player.current_song.get('original_query_info')), 'position': round(source.position, 1), 'paused': vc.is_paused()}
+    return {'current': current, 'autoplay': player.autoplay, 'history': encode_queue_item(player.history), 'history_label': player.history_label, 'voice_channel_id': vc.channel.id if vc else None, 'text_channel_id': player.text_channel_id, 'recent_ids': list(player.recent_ids)}
+
+state_store = None
+if STATE_DB_PATH:
+    try: state_store = PlayerStateStore(STATE_DB_PATH)
+    except sqlite3.Error as e: print(f"State pemutar tidak bisa dibuka ({STATE_DB_PATH}): {e}")
+
+class RestoreContext:
+    # Pengganti ctx untuk pemutaran yang dilanjutkan setelah restart (tanpa pesan perintah asli)
+    def __init__(self, guild, channel):
+        self.guild = guild; self.channel = channel; self.author = guild.me
+
+    @property
+    def voice_client(self): return self.guild.voice_client
+
+restore_semaphore = asyncio.Semaphore(2) # Batasi guild yang resolve & join VC bersamaan setelah restart
+
+def ensure_state_flusher():
+    if state_store and not state_store.flusher and not state_store.closed: state_store.flusher = spawn_task(state_store.run_flusher())
+
+def install_shutdown_handler():
+    # SIGTERM (supervisor cluster/systemd) menutup bot dengan rapi, bukan mematikan proses di tengah tulis
+    try: asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: spawn_task(bot.close()))
+    except NotImplementedError: pass # Windows: tidak ada signal handler di event loop
+
+# --- Endpoint Metrik Prometheus ---
+def executor_backlog(executor):
+    queue = getattr(executor, '_work_queue', None) # ThreadPoolExecutor; ProcessPoolExecutor tidak punya antrian yang bisa dibaca
+    return queue.qsize() if queue is not None else 0
+
+def collect_gauges():
+    active_by_shard = {}
+    for vc in bot.voice_clients:
+        if vc.is_playing(): active_by_shard[vc.guild.shard_id or 0] = active_by_shard.get(vc.guild.shard_id or 0, 0) + 1
+    executors = {'extract': extraction_pool.queue_depth(), 'spotify': executor_backlog(spotify_api._executor) if spotify_api else 0,
+                 'audiocache': executor_backlog(audio_cache._executor) if audio_cache else 0, 'statedb': executor_backlog(state_store._executor) if state_store else 0}
+    return [
+        ('musicbot_players', 'Pemutar guild yang terdaftar', {(): len(players)}),
+        ('musicbot_players_active', 'Guild yang sedang memutar lagu per shard', {(('shard', str(k)),): v for k, v in active_by_shard.items()} or {(): 0}),
+        ('musicbot_queue_items', 'Total item di semua antrian', {(): sum(len(p.queue) for p in players.values())}),
+        ('musicbot_executor_queue_depth', 'Tugas yang menunggu di executor', {(('pool', k),): v for k, v in executors.items()}),
+        ('musicbot_extract_active', 'Slot ekstraksi yang sedang dipakai', {(): extraction_pool._active}),
+        ('musicbot_extract_limit', 'Batas konkurensi ekstraksi adaptif', {(): extraction_pool.limit}),
+        ('musicbot_breaker_state', 'State circuit breaker ekstraksi', {(('state', k),): int(extraction_breaker.state == k) for k in ('closed', 'open', 'half_open')}),
+        ('musicbot_gateway_latency_seconds', 'Latensi heartbeat gateway', {(('shard', str(sid)),): lat for sid, lat in (bot.latencies if isinstance(bot, commands.AutoShardedBot) else [(bot.shard_id or 0, bot.latency)]) if lat == lat}),
+        ('musicbot_startup_phase_seconds', 'Durasi tiap fase startup', {(('phase', k),): v for k, v in startup_phases.items()}),
+        ('musicbot_audio_cache_bytes', 'Ukuran cache audio di disk', {(): audio_cache.total_bytes if audio_cache else 0}),
+        ('musicbot_audio_cache_entries', 'Lagu di cache audio', {(): len(audio_cache.entries) if audio_cache else 0}),
+        ('musicbot_state_pending_restore', 'Guild tersimpan yang belum dipulihkan', {(): state_store.stats()['pending_restore'] if state_store else 0}),
+        ('musicbot_loop_lag_max_seconds', 'Lag event loop terbesar sejak start', {(): metrics.loop_lag_max}),
+    ]
+
+def collect_counters():
+    return [
+        ('musicbot_commands_total', 'Perintah yang dijalankan', {(('command', k),): v for k, v in metrics.commands.items()}),
+        ('musicbot_resolve_cache_total', 'Lookup cache resolve', {(('result', 'hit'),): resolve_cache.hits, (('result', 'miss'),): resolve_cache.misses}),
+        ('musicbot_audio_cache_total', 'Lookup & unduhan cache audio', {(('result', k),): v for k, v in (audio_cache.stats() if audio_cache else {}).items() if k in ('hits', 'misses', 'downloads', 'download_failures', 'evictions')}),
+        ('musicbot_playback_path_total', 'Jalur playback yang dipakai', {(('path', k),): v for k, v in playback_path_counts.items()}),
+        ('musicbot_gapless_total', 'Transisi gapless (disiapkan/tersambung/dibuang/gagal)', {(('result', k),): v for k, v in gapless_stats.items()}),
+        ('musicbot_stream_recovery_total', 'Pemulihan stream yang putus', {(('result', k),): stream_recovery_stats[k] for k in ('attempts', 'recovered', 'failed')}),
+        ('musicbot_autoplay_total', 'Pengambilan kandidat autoplay', {(('result', k),): v for k, v in autoplay_engine.stats().items() if k in ('fetches', 'hits', 'fallbacks')}),
+        ('musicbot_breaker_total', 'Circuit breaker ekstraksi', {(('event', 'trip'),): extraction_breaker.total_trips, (('event', 'rejected'),): extraction_breaker.rejected}),
+        ('musicbot_teardown_total', 'Teardown guild per alasan (stop/idle/empty/kicked)', {(('reason', k),): v for k, v in reaper.reaped.items()}),
+        ('musicbot_reclaimed_total', 'Sumber daya yang dibersihkan saat teardown', {(('resource', k),): v for k, v in reaper.reclaimed.items()}),
+        ('musicbot_state_store_total', 'Penulisan & pemulihan state pemutar', {(('event', k),): v for k, v in (state_store.stats() if state_store else {}).items() if k in ('flushes', 'queue_writes', 'meta_writes', 'restored')}),
+        ('musicbot_message_updates_total', 'Update pesan Now Playing', {(('result', k),): v for k, v in message_updates.stats().items() if k in ('submitted', 'merged', 'in_place', 'requests', 'paced')}),
+    ]
+
+def format_labels(labels, extra=()):
+    pairs = tuple(labels) + tuple(extra)
+    return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}' if pairs else ''
+
+def render_metrics():
+    lines = []
+    for kind, families in (('gauge', collect_gauges()), ('counter', collect_counters())):
+        for name, help_text, samples in families:
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}']
+            lines += [f'{name}{format_labels(labels)} {value}' for labels, value in samples.items()]
+    histograms = [((('stage', stage),), hist) for stage, hist in sorted(metrics.stages.items())]
+    for name, help_text, series in (('musicbot_stage_seconds', 'Durasi tiap tahap hot path', histograms), ('musicbot_loop_lag_seconds', 'Lag event loop', [((), metrics.loop_lag)])):
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+        for labels, hist in series:
+            cumulative = 0
+            for bound, count in zip(METRIC_BUCKETS + ('+Inf',), hist.counts):
+                cumulative += count; lines.append(f'{name}_bucket{format_labels(labels, (("le", bound),))} {cumulative}')
+            lines += [f'{name}_sum{format_labels(labels)} {hist.total}', f'{name}_count{format_labels(labels)} {hist.count}']
+    return '\n'.join(lines) + '\n'
+
+async def handle_metrics_request(reader, writer):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        while (await asyncio.wait_for(reader.readline(), 5)) not in (b'\r\n', b'\n', b''): pass
+        ok = request_line.split(b' ')[1:2] == [b'/metrics']
+        body = (render_metrics() if ok else 'not found\n').encode()
+        writer.write(f"HTTP/1.1 {'200 OK' if ok else '404 Not Found'}\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError): pass
+    finally: writer.close()
+
+async def ensure_metrics_services():
+    if not metrics.sampler: metrics.sampler = spawn_task(metrics.sample_loop_lag())
+    if METRICS_PORT and not metrics.server:
+        port = METRICS_PORT + int(CLUSTER_ID or 0) # Tiap proses cluster punya port sendiri
+        try: metrics.server = await asyncio.start_server(handle_metrics_request, METRICS_HOST, port); print(f"Metrik Prometheus: http://{METRICS_HOST}:{port}/metrics")
+        except OSError as e: metrics.server = False; print(f"Endpoint metrik gagal dibuka di port {port}: {e}")
+
+@bot.before_invoke
+async def mark_command_start(ctx):
+    ctx.invoke_started = time.perf_counter()
+    metrics.observe('command_receipt', max(0.0, (discord.utils.utcnow() - ctx.message.created_at).total_seconds())) # Discord -> bot sampai perintah mulai jalan
+
+@bot.after_invoke
+async def record_command_time(ctx):
+    metrics.commands[ctx.command.name] = metrics.commands.get(ctx.command.name, 0) + 1
+    started = getattr(ctx, 'invoke_started', None)
+    if started: metrics.observe(f'command_{ctx.command.name}', time.perf_counter() - started)
+
+async def restore_guild_state(guild):
+    # Hanya data antrian yang dipulihkan (tanpa resolve); lagu saat ini dilanjutkan dari posisi terakhir jika ada pendengar
+    try: row = await state_store.load(guild.id)
+    finally: state_store.pending_guilds.discard(guild.id)
+    if not row or guild.id in players: return # Sesi baru sudah dimulai sebelum restore selesai
+    queue_items, meta = row
+    player = get_player(guild.id); player.queue.extend(queue_items)
+    player.autoplay = meta.get('autoplay', False); player.history = decode_queue_item(meta['history']) if meta.get('history') is not None else None
+    player.history_label = meta.get('history_label')
+    player.text_channel_id = meta.get('text_channel_id'); player.recent_ids.extend(meta.get('recent_ids', []))
+    current = meta.get('current')
+    if current and current.get('item') is not None:
+        item = decode_queue_item(current['item']); player.queue.appendleft(item); player.seek_on_start = (item, current.get('position', 0))
+    state_store.restored += 1
+    print(f"State guild {guild.id} dipulihkan: {len(player.queue)} lagu di antrian.")
+    voice_channel = guild.get_channel(meta.get('voice_channel_id') or 0); text_channel = guild.get_channel(player.text_channel_id or 0)
+    if not (STATE_AUTO_RESUME and current and not current.get('paused') and voice_channel and any(not m.bot for m in voice_channel.members)): return
+    async with restore_semaphore:
+        try:
+            if not guild.voice_client: await voice_channel.connect()
+            await player.scheduler.advance(RestoreContext(guild, text_channel), only_if_idle=True)
+        except Exception as e: print(f"Gagal melanjutkan pemutaran guild {guild.id}: {e}")
+
+# --- Teardown Guild & Reaper Voice Client Diam/Kosong ---
+def kill_leftover_ffmpeg(player, current=None):
+    # Source yang sedang diputar dibersihkan player audio discord.py; sisanya (gagal diputar, lookahead) dibunuh di sini
+    killed = 0
+    for source in list(player.sources):
+        process = ffmpeg_process(source)
+        if source is current or not process or process.poll() is not None: continue
+        try: source.cleanup(); killed += 1
+        except Exception as e: print(f"Gagal membunuh ffmpeg sisa: {e}")
+    return killed
+
+async def teardown_guild(guild, reason):
+    # Satu jalur pembersihan untuk stop, tombol Stop, dan reaper: VC, state per guild, task background, proses ffmpeg
+    player = find_player(guild.id); vc = guild.voice_client; current = current_track_source(vc)
+    reclaimed = {'voice': 0, 'queue_items': len(player.queue) if player else 0, 'prefetch': len(player.prefetch) if player else 0, 'imports': len(player.imports) if player else 0, 'ffmpeg': 0}
+    released = release_player(guild.id)
+    if vc:
+        if vc.is_playing() or vc.is_paused(): stop_current(vc)
+        try: await vc.disconnect(force=True); reclaimed['voice'] = 1
+        except Exception as e: print(f"Gagal keluar VC guild {guild.id}: {e}")
+    if released: reclaimed['ffmpeg'] = kill_leftover_ffmpeg(released, current)
+    reaper.record(guild.id, reason, reclaimed)
+    return released
+
+class VoiceReaper:
+    REASON_TEXT = {'idle': "Tidak ada lagu diputar selama {:.0f} detik.", 'empty': "Voice channel kosong selama {:.0f} detik."}
+
+    def __init__(self):
+        self.idle_since = {} # guild_id -> monotonic saat bot mulai diam
+        self.empty_since = {} # guild_id -> monotonic saat VC tinggal bot saja (diisi dari on_voice_state_update)
+        self.reaped = {}; self.reclaimed = {}
+        self.task = None
+
+    def forget(self, guild_id):
+        self.idle_since.pop(guild_id, None); self.empty_since.pop(guild_id, None)
+
+    def update_listeners(self, guild):
+        vc = guild.voice_client
+        if vc and vc.channel and not any(not m.bot for m in vc.channel.members): self.empty_since.setdefault(guild.id, time.monotonic())
+        else: self.empty_since.pop(guild.id, None)
+
+    def record(self, guild_id, reason, reclaimed):
+        self.reaped[reason] = self.reaped.get(reason, 0) + 1
+        for key, value in reclaimed.items(): self.reclaimed[key] = self.reclaimed.get(key, 0) + value
+        if reason != 'stop': print(f"Reaper: guild {guild_id} ({reason}) dibersihkan — " + ', '.join(f"{k} {v}" for k, v in reclaimed.items()))
+
+    def due(self, guild_id, now):
+        if EMPTY_CHANNEL_TIMEOUT and guild_id in self.empty_since and now - self.empty_since[guild_id] >= EMPTY_CHANNEL_TIMEOUT: return 'empty'
+        if IDLE_TIMEOUT and guild_id in self.idle_since and now - self.idle_since[guild_id] >= IDLE_TIMEOUT: return 'idle'
+        return None
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(REAPER_INTERVAL)
+            now = time.monotonic()
+            for vc in list(bot.voice_clients):
+                guild = vc.guild
+                if guild.voice_client is not vc: continue # Sudah diputus, belum hilang dari daftar
+                player = find_player(guild.id)
+                if vc.is_playing() or vc.is_paused() or (player and player.queue_held()): self.idle_since.pop(guild.id, None)
+                else: self.idle_since.setdefault(guild.id, now)
+                reason = self.due(guild.id, now)
+                if reason: self.forget(guild.id); spawn_task(self.reap(guild, reason))
+
+    async def reap(self, guild, reason):
+        player = find_player(guild.id); text_channel = guild.get_channel(player.text_channel_id) if player and player.text_channel_id else None
+        await teardown_guild(guild, reason)
+        if text_channel:
+            timeout = EMPTY_CHANNEL_TIMEOUT if reason == 'empty' else IDLE_TIMEOUT
+            embed = discord.Embed(title="👋 Keluar dari Voice Channel", description=self.REASON_TEXT[reason].format(timeout) + f" Gunakan `{BOT_PREFIX}play` untuk memutar lagi.", color=discord.Color.light_grey()); embed.set_footer(text=WATERMARK_TEXT)
+            try: await text_channel.send(embed=embed)
+            except discord.HTTPException: pass
+
+reaper = VoiceReaper()
+
+async def warm_up_clients():
+    # Muat yt_dlp & client Spotify setelah bot online, supaya perintah pertama tidak menanggung biayanya
+    started = time.perf_counter(); loop = asyncio.get_running_loop()
+    if extraction_pool.mode == 'process': warm_ups = [loop.run_in_executor(extraction_pool.executor, _warm_youtube_dl) for _ in range(extraction_pool.workers)] # yt_dlp dipakai di worker, bukan di proses utama
+    else: warm_ups = [asyncio.to_thread(load_youtube_dl)]
+    await asyncio.gather(*warm_ups, ensure_spotify_api(), return_exceptions=True)
+    record_startup_phase('warm-up (background)', started)
+    print("Fase startup: " + ' · '.join(f"{name} {seconds:.2f}s" for name, seconds in startup_phases.items()))
+
+def ensure_reaper():
+    if (IDLE_TIMEOUT or EMPTY_CHANNEL_TIMEOUT) and not reaper.task: reaper.task = spawn_task(reaper.run())
+
+@bot.event
+async def on_voice_state_update(member, before, after):
+    guild = member.guild
+    if member.id == bot.user.id:
+        if before.channel and after.channel is None and guild.id in players: # Diputus dari luar (kick / channel dihapus): tetap bersihkan state
+            spawn_task(teardown_guild(guild, 'kicked'))
+        elif after.channel: reaper.update_listeners(guild)
+        return
+    vc = guild.voice_client
+    if vc and vc.channel in (before.channel, after.channel): reaper.update_listeners(guild)
+
+@bot.event
+async def on_guild_available(guild):
+    ensure_state_flusher()
+    if state_store and guild.id in state_store.pending_guilds: spawn_task(restore_guild_state(guild))
 
 @bot.event
 async def on_ready():
+    ensure_state_flusher(); ensure_reaper(); await ensure_metrics_services()
+    if 'gateway siap' not in startup_phases:
+        record_startup_phase('gateway siap', startup_mark); spawn_task(warm_up_clients())
     print(f'Bot {bot.user.name} (ID: {bot.user.id}) online!')
     print(f'Prefix: {BOT_PREFIX}')
-    print(f'Spotify API: {"Ya" if sp else "Tidak"}')
+    print(f'Spotify API: {"Ya" if SPOTIFY_ENABLED else "Tidak"}')
+    if CLUSTER_ID is not None: print(f'Cluster: #{CLUSTER_ID}')
+    for shard_id, guild_count, voice_count in shard_report():
+        print(f'Shard {shard_id}: {guild_count} guild, {voice_count} voice client')
     print('------')
     await bot.change_presence(activity=discord.Game(name=f"{WATERMARK_TEXT} | {BOT_PREFIX}help"))
 
+@bot.event
+async def on_shard_ready(shard_id):
+    print(f'Shard {shard_id} siap ({sum(1 for g in bot.guilds if g.shard_id == shard_id)} guild).')
+
+def shard_report():
+    # (shard_id, jumlah guild, jumlah voice client) untuk shard yang dipegang proses ini
+    shard_ids = sorted(bot.shards) if isinstance(bot, commands.AutoShardedBot) else [bot.shard_id or 0]
+    guild_counts = {sid: 0 for sid in shard_ids}; voice_counts = {sid: 0 for sid in shard_ids}
+    for guild in bot.guilds: guild_counts[guild.shard_id] = guild_counts.get(guild.shard_id, 0) + 1
+    for vc in bot.voice_clients: voice_counts[vc.guild.shard_id] = voice_counts.get(vc.guild.shard_id, 0) + 1
+    return [(sid, guild_counts[sid], voice_counts.get(sid, 0)) for sid in sorted(guild_counts)]
+
+# --- Import Playlist Bertahap (Streaming Enqueue) ---
+STREAM_SUMMARY_EDIT_INTERVAL = 2.0 # Detik minimal antar edit embed ringkasan
+
+def queue_item_label(item_data):
+    return (item_data.label or 'Lagu') if isinstance(item_data, QueuedTrack) else str(item_data)
+
+def build_added_summary_embed(preview_titles, num_actually_queued, source_name_for_summary, source_thumbnail_for_summary, loading_note=None):
+    embed_summary = discord.Embed(color=discord.Color.blurple()); embed_summary.set_footer(text=WATERMARK_TEXT)
+    if source_thumbnail_for_summary: embed_summary.set_thumbnail(url=source_thumbnail_for_summary)
+    title_text = f"➕ {num_actually_queued} Lagu Ditambahkan"
+    if source_name_for_summary and source_name_for_summary != "Lagu Spotify": title_text += f" dari {source_name_for_summary}"
+    description_text = "\n".join(f"`{i+1}.` {title}" for i, title in enumerate(preview_titles[:10]))
+    if num_actually_queued > 10: description_text += f"\n...dan {num_actually_queued - 10} lagu lainnya."
+    if loading_note: description_text += f"\n\n{loading_note}"
+    embed_summary.title = title_text; embed_summary.description = description_text
+    return embed_summary
+
+def cancel_imports(guild_id):
+    player = find_player(guild_id)
+    if not player: return
+    for task in player.imports: task.cancel()
+    player.imports.clear()
+
+async def stream_playlist_import(ctx, pages, summary_message, preview_titles, num_queued, num_loaded, playlist_total, source_name, source_thumbnail):
+    # Tambahkan sisa halaman playlist ke antrian saat tiba; dibatalkan oleh stop/clearqueue
+    guild_id = ctx.guild.id; last_edit = time.monotonic(); loading_note = None
+    try:
+        async for page in pages:
+            new_items = spotify_playlist_page_to_items(page['items'], source_thumbnail)
+            queue = get_player(guild_id).queue
+            for item_data in new_items:
+                queue.append(item_data)
+                if len(preview_titles) < 10: preview_titles.append(queue_item_label(item_data))
+            num_queued += len(new_items); num_loaded += len(page['items'])
+            vc = ctx.voice_client
+            if vc and not (vc.is_playing() or vc.is_paused()) and queue: await play_next(ctx) # Antrian sempat habis sebelum halaman ini tiba
+            else: schedule_prefetch(guild_id)
+            if time.monotonic() - last_edit >= STREAM_SUMMARY_EDIT_INTERVAL:
+                last_edit = time.monotonic()
+                try: await summary_message.edit(embed=build_added_summary_embed(preview_titles, num_queued, source_name, source_thumbnail, f"⏳ Memuat sisa playlist... ({num_loaded}/{playlist_total})"))
+                except discord.HTTPException: pass
+    except asyncio.CancelledError:
+        loading_note = "⏹️ Import playlist dibatalkan."
+        raise
+    except Exception as e:
+        print(f"Error import playlist bertahap (guild {guild_id}): {e}")
+        loading_note = f"⚠️ Import berhenti: `{type(e).__name__}`"
+    finally:
+        await pages.aclose()
+        try: await summary_message.edit(embed=build_added_summary_embed(preview_titles, num_queued, source_name, source_thumbnail, loading_note))
+        except discord.HTTPException: pass
+
 # --- Perintah Play ---
-@bot.command(name='play', aliases=['p', 'mainkan'], help='Putar musik dari YouTube/Spotify URL/pencarian.')
-async def play(ctx, *, query: str):
+async def join_author_voice(ctx):
+    # VC siap pakai, atau None (pesan alasan sudah dikirim) jika user tidak di VC / beda VC / gagal masuk
     if not ctx.author.voice:
         embed_err_vc = discord.Embed(description="⚠️ Kamu harus ada di voice channel dulu!", color=discord.Color.orange()); embed_err_vc.set_footer(text=WATERMARK_TEXT)
-        await ctx.send(embed=embed_err_vc); return
+        await ctx.send(embed=embed_err_vc); return None
     
     vc = ctx.voice_client
     if not vc: 
         try: vc = await ctx.author.voice.channel.connect()
         except Exception as e:
             embed_err_join_vc = discord.Embed(title="⚠️ Gagal Masuk VC", description=f"Tidak bisa masuk: `{e}`", color=discord.Color.red()); embed_err_join_vc.set_footer(text=WATERMARK_TEXT)
-            await ctx.send(embed=embed_err_join_vc); return
+            await ctx.send(embed=embed_err_join_vc); return None
         else: 
             embed_join = discord.Embed(description=f"➡️ Masuk ke **{ctx.author.voice.channel.name}**.", color=discord.Color.light_grey()); embed_join.set_footer(text=WATERMARK_TEXT)
             await ctx.send(embed=embed_join)
             
     elif vc.channel != ctx.author.voice.channel: 
         embed_err_same_vc = discord.Embed(description="⚠️ Kamu harus di voice channel yang sama.", color=discord.Color.orange()); embed_err_same_vc.set_footer(text=WATERMARK_TEXT)
-        await ctx.send(embed=embed_err_same_vc); return
+        await ctx.send(embed=embed_err_same_vc); return None
+    return vc
 
-    guild_id = ctx.guild.id
-    if guild_id not in music_queue: music_queue[guild_id] = []
+@bot.command(name='play', aliases=['p', 'mainkan'], help='Putar musik dari YouTube/Spotify URL/pencarian.')
+async def play(ctx, *, query: str):
+    vc = await join_author_voice(ctx)
+    if not vc: return
+
+    guild_id = ctx.guild.id; player_state = get_player(guild_id)
 
     async with ctx.typing():
         loading_embed = discord.Embed(title="🔍 Mencari Info...", description="Mohon tunggu...", color=discord.Color.gold()); loading_embed.set_footer(text=WATERMARK_TEXT)
@@ -360,35 +2014,36 @@ async def play(ctx, *, query: str):
 
         items_to_add_to_bot_queue = [] 
         source_name_for_summary, source_thumbnail_for_summary = "", None 
+        remaining_pages, playlist_total = None, 0 # Diisi jika playlist dimuat bertahap
 
         try:
             spotify_track_match = re.match(r'https?://open\.spotify\.com/(intl-\w+/)?track/([a-zA-Z0-9]+)', query)
             spotify_album_match = re.match(r'https?://open\.spotify\.com/(intl-\w+/)?album/([a-zA-Z0-9]+)', query)
             spotify_playlist_match = re.match(r'https?://open\.spotify\.com/(intl-\w+/)?playlist/([a-zA-Z0-9]+)', query)
 
-            if sp and (spotify_track_match or spotify_album_match or spotify_playlist_match):
+            if (spotify_track_match or spotify_album_match or spotify_playlist_match) and await ensure_spotify_api():
                 if spotify_track_match:
-                    track_id = spotify_track_match.group(2); track_info_spotify = sp.track(track_id)
+                    track_id = spotify_track_match.group(2); track_info_spotify = await spotify_api.track(track_id)
                     source_name_for_summary = "Lagu Spotify"
                     source_thumbnail_for_summary = track_info_spotify['album']['images'][0]['url'] if track_info_spotify['album']['images'] else None
-                    items_to_add_to_bot_queue.append({'title': track_info_spotify['name'], 'artist': track_info_spotify['artists'][0]['name'], 'query_for_yt_dlp': f"{track_info_spotify['artists'][0]['name']} - {track_info_spotify['name']} audio", 'spotify_url': query, 'thumbnail': source_thumbnail_for_summary})
+                    items_to_add_to_bot_queue.append(spotify_track_to_item(track_info_spotify, source_thumbnail_for_summary, spotify_url=query))
                 elif spotify_album_match:
-                    album_id = spotify_album_match.group(2); album_info_spotify = sp.album(album_id)
+                    album_id = spotify_album_match.group(2); album_info_spotify = await spotify_api.album(album_id)
                     source_name_for_summary = f"Album: **{album_info_spotify['name']}**"; source_thumbnail_for_summary = album_info_spotify['images'][0]['url'] if album_info_spotify['images'] else None
-                    for item in sp.album_tracks(album_id)['items']: items_to_add_to_bot_queue.append({'title': item['name'], 'artist': item['artists'][0]['name'], 'query_for_yt_dlp': f"{item['artists'][0]['name']} - {item['name']} audio", 'spotify_url': item.get('external_urls',{}).get('spotify'), 'thumbnail': source_thumbnail_for_summary})
+                    async for page in spotify_api.album_track_pages(album_id, first_page=album_info_spotify.get('tracks')): # Semua halaman, bukan hanya 50 pertama
+                        items_to_add_to_bot_queue.extend(spotify_track_to_item(item, source_thumbnail_for_summary) for item in page['items'] if item and item.get('artists'))
                 elif spotify_playlist_match:
-                    playlist_id = spotify_playlist_match.group(2); playlist_info_spotify = sp.playlist(playlist_id)
+                    playlist_id = spotify_playlist_match.group(2); playlist_info_spotify = await spotify_api.playlist(playlist_id)
                     source_name_for_summary = f"Playlist: **{playlist_info_spotify['name']}**"; source_thumbnail_for_summary = playlist_info_spotify['images'][0]['url'] if playlist_info_spotify['images'] else None
-                    offset = 0
-                    while True:
-                        results = sp.playlist_items(playlist_id, fields='items(track(name,artists(name),external_urls(spotify),album(images))),next', limit=100, offset=offset)
-                        for item_wrapper in results['items']:
-                            item = item_wrapper.get('track')
-                            if item and item.get('name') and item.get('artists'):
-                                thumb = item.get('album', {}).get('images'); thumb_url = thumb[0]['url'] if thumb else source_thumbnail_for_summary
-                                items_to_add_to_bot_queue.append({'title': item['name'], 'artist': item['artists'][0]['name'], 'query_for_yt_dlp': f"{item['artists'][0]['name']} - {item['name']} audio", 'spotify_url': item.get('external_urls',{}).get('spotify'), 'thumbnail': thumb_url})
-                        if results['next']: offset += 100
-                        else: break
+                    playlist_pages = spotify_api.playlist_pages(playlist_id)
+                    if SPOTIFY_STREAMING_ENQUEUE:
+                        first_page = await anext(playlist_pages, None)
+                        if first_page:
+                            items_to_add_to_bot_queue.extend(spotify_playlist_page_to_items(first_page['items'], source_thumbnail_for_summary))
+                            if (first_page.get('total') or 0) > len(first_page['items']): remaining_pages, playlist_total = playlist_pages, first_page['total']
+                    else:
+                        async for page in playlist_pages:
+                            items_to_add_to_bot_queue.extend(spotify_playlist_page_to_items(page['items'], source_thumbnail_for_summary))
                 if not items_to_add_to_bot_queue and (spotify_album_match or spotify_playlist_match) : 
                      embed_empty = discord.Embed(title="🤔 Info Spotify", description=f"Tidak ada lagu dari {source_name_for_summary or 'link Spotify'}.", color=discord.Color.gold()); embed_empty.set_footer(text=WATERMARK_TEXT)
                      await status_message.edit(embed=embed_empty); return
@@ -397,9 +2052,9 @@ async def play(ctx, *, query: str):
         except Exception as e: 
             await status_message.delete()
             error_text = f"Gagal memproses permintaan: `{type(e).__name__}`."; fallback_to_query = False
-            if sp and (spotify_track_match or spotify_album_match or spotify_playlist_match):
+            if spotify_api and (spotify_track_match or spotify_album_match or spotify_playlist_match):
                 error_text = f"Gagal mengambil info dari Spotify: `{type(e).__name__}`.\nMencoba sebagai pencarian biasa..."
-                print(f"Error Spotify processing: {e}"); items_to_add_to_bot_queue = [query]; fallback_to_query = True 
+                print(f"Error Spotify processing: {e}"); items_to_add_to_bot_queue = [query]; remaining_pages = None; fallback_to_query = True 
             else: print(f"Error processing query '{query}': {e}")
             embed_err_fetch = discord.Embed(title="⚠️ Error Pemrosesan", description=error_text, color=discord.Color.orange()); embed_err_fetch.set_footer(text=WATERMARK_TEXT)
             await ctx.send(embed=embed_err_fetch)
@@ -410,44 +2065,129 @@ async def play(ctx, *, query: str):
             await ctx.send(embed=embed_no_items_final); return
 
         is_currently_playing_or_paused = vc.is_playing() or vc.is_paused()
-        queue_was_empty_before_adding = not music_queue[guild_id]
+        queue_was_empty_before_adding = not player_state.queue
+        vc_was_idle = not is_currently_playing_or_paused and not player_state.queue_held() # Antrian hasil restore yang belum jalan juga harus dimulai
         
         songs_added_for_summary_message_list = []
         first_item_played_this_call = False
 
         if not is_currently_playing_or_paused and queue_was_empty_before_adding and items_to_add_to_bot_queue:
             item_to_play_now = items_to_add_to_bot_queue.pop(0)
-            music_queue[guild_id].insert(0, item_to_play_now) 
+            player_state.queue.appendleft(item_to_play_now) 
             await play_next(ctx) 
             first_item_played_this_call = True
-            if not items_to_add_to_bot_queue: return 
+            if not items_to_add_to_bot_queue and not remaining_pages: return 
         
         for item_data in items_to_add_to_bot_queue:
-            music_queue[guild_id].append(item_data)
-            title = item_data.get('title', 'Lagu') if isinstance(item_data, dict) else str(item_data)
-            artist = item_data.get('artist', '') if isinstance(item_data, dict) else ''
-            songs_added_for_summary_message_list.append(f"{artist} - {title}".strip(" - ") if artist else title)
+            player_state.queue.append(item_data)
+            songs_added_for_summary_message_list.append(queue_item_label(item_data))
         
-        if songs_added_for_summary_message_list:
-            embed_summary = discord.Embed(color=discord.Color.blurple()); embed_summary.set_footer(text=WATERMARK_TEXT)
-            if source_thumbnail_for_summary: embed_summary.set_thumbnail(url=source_thumbnail_for_summary)
-            num_actually_queued = len(songs_added_for_summary_message_list)
-            title_text = f"➕ {num_actually_queued} Lagu Ditambahkan"
-            if source_name_for_summary and source_name_for_summary != "Lagu Spotify": title_text += f" dari {source_name_for_summary}"
-            description_text = "\n".join(f"`{i+1}.` {title}" for i, title in enumerate(songs_added_for_summary_message_list[:10]))
-            if num_actually_queued > 10: description_text += f"\n...dan {num_actually_queued - 10} lagu lainnya."
-            embed_summary.title = title_text; embed_summary.description = description_text
-            await ctx.send(embed=embed_summary)
-
-        if queue_was_empty_before_adding and not first_item_played_this_call and music_queue[guild_id] and not (vc.is_playing() or vc.is_paused()):
+        if songs_added_for_summary_message_list or remaining_pages:
+            num_loaded = len(items_to_add_to_bot_queue) + (1 if first_item_played_this_call else 0)
+            loading_note = f"⏳ Memuat sisa playlist... ({num_loaded}/{playlist_total})" if remaining_pages else None
+            embed_summary = build_added_summary_embed(songs_added_for_summary_message_list[:10], len(songs_added_for_summary_message_list), source_name_for_summary, source_thumbnail_for_summary, loading_note)
+            summary_message = await ctx.send(embed=embed_summary)
+            if remaining_pages:
+                task = bot.loop.create_task(stream_playlist_import(ctx, remaining_pages, summary_message, songs_added_for_summary_message_list[:10], len(songs_added_for_summary_message_list), num_loaded, playlist_total, source_name_for_summary, source_thumbnail_for_summary))
+                player_state.imports.add(task); task.add_done_callback(player_state.imports.discard)
+
+        if vc_was_idle and not first_item_played_this_call and player_state.queue and not (vc.is_playing() or vc.is_paused()):
             await play_next(ctx)
+        else: schedule_prefetch(guild_id)
+
+# --- Perintah Play Batch (banyak query sekaligus) ---
+SPOTIFY_URL_RE = re.compile(r'https?://open\.spotify\.com/(intl-\w+/)?(track|album|playlist)/([a-zA-Z0-9]+)')
+
+async def read_batch_entries(ctx, text):
+    lines = (text or '').splitlines()
+    for attachment in ctx.message.attachments:
+        if attachment.filename.lower().endswith('.txt') and attachment.size <= 256 * 1024:
+            lines += (await attachment.read()).decode('utf-8', errors='ignore').splitlines()
+    return [line.strip() for line in lines if line.strip() and not line.strip().startswith('#')]
+
+async def resolve_batch_entry(entry, guild_id):
+    # -> [(item antrian, label)]; album/playlist Spotify dijabarkan jadi banyak item sesuai urutannya
+    match = SPOTIFY_URL_RE.match(entry)
+    if match and await ensure_spotify_api():
+        kind, spotify_id = match.group(2), match.group(3)
+        if kind == 'track':
+            track = await spotify_api.track(spotify_id); thumb = track['album']['images'][0]['url'] if track['album']['images'] else None
+            items = [spotify_track_to_item(track, thumb, spotify_url=entry)]
+        elif kind == 'album':
+            album = await spotify_api.album(spotify_id); thumb = album['images'][0]['url'] if album['images'] else None; items = []
+            async for page in spotify_api.album_track_pages(spotify_id, first_page=album.get('tracks')):
+                items.extend(spotify_track_to_item(item, thumb) for item in page['items'] if item and item.get('artists'))
+        else:
+            playlist = await spotify_api.playlist(spotify_id); thumb = playlist['images'][0]['url'] if playlist['images'] else None; items = []
+            async for page in spotify_api.playlist_pages(spotify_id): items.extend(spotify_playlist_page_to_items(page['items'], thumb))
+        return [(item, queue_item_label(item)) for item in items]
+    try: data = await YTDLSource.extract_data(entry, stream=True, guild_id=guild_id) # Hasil masuk cache resolve, pemutaran nanti tanpa ekstraksi ulang
+    except ExtractionPaused: return [(entry, entry)] # Breaker terbuka: antrekan apa adanya, di-resolve saat diputar
+    return [(entry, data.get('title') or entry)]
+
+@bot.command(name='playbatch', aliases=['pb', 'putarbanyak'], help='Tambah banyak lagu sekaligus: satu query/URL per baris, atau lampirkan file .txt.')
+async def playbatch(ctx, *, queries: str = None):
+    entries = await read_batch_entries(ctx, queries)
+    if not entries:
+        embed = discord.Embed(description=f"⚠️ Tulis satu lagu/URL per baris setelah `{BOT_PREFIX}playbatch`, atau lampirkan file `.txt`.", color=discord.Color.orange()); embed.set_footer(text=WATERMARK_TEXT)
+        return await ctx.send(embed=embed)
+    skipped = max(0, len(entries) - BATCH_MAX_ENTRIES); entries = entries[:BATCH_MAX_ENTRIES]
+    vc = await join_author_voice(ctx)
+    if not vc: return
+    guild_id = ctx.guild.id; player_state = get_player(guild_id)
+
+    async with ctx.typing():
+        loading_embed = discord.Embed(title="🔍 Memproses Batch...", description=f"Mencari {len(entries)} entri...", color=discord.Color.gold()); loading_embed.set_footer(text=WATERMARK_TEXT)
+        status_message = await ctx.send(embed=loading_embed)
+        semaphore = asyncio.Semaphore(max(1, BATCH_RESOLVE_CONCURRENCY))
+        async def resolve(entry):
+            async with semaphore:
+                try: return await resolve_batch_entry(entry, guild_id)
+                except Exception as e: print(f"Batch: gagal resolve '{entry}': {e}"); return None
+        results = await asyncio.gather(*(resolve(entry) for entry in entries)) # Urutan hasil = urutan input
+
+    if find_player(guild_id) is not player_state: # Di-stop selama resolve
+        embed_cancel = discord.Embed(description="⏹️ Batch dibatalkan, tidak ada lagu yang ditambahkan.", color=discord.Color.orange()); embed_cancel.set_footer(text=WATERMARK_TEXT)
+        try: await status_message.edit(embed=embed_cancel)
+        except discord.HTTPException: pass
+        return
+    resolved = [pair for result in results if result for pair in result]
+    failed = [entry for entry, result in zip(entries, results) if not result]
+    vc_was_idle = not (vc.is_playing() or vc.is_paused()) and not player_state.queue_held()
+    player_state.queue.extend(item for item, _ in resolved) # Satu kali masuk antrian untuk semua entri
+
+    notes = []
+    if failed: notes.append(f"⚠️ {len(failed)} entri gagal: " + ', '.join(f"`{entry[:40]}`" for entry in failed[:5]))
+    if skipped: notes.append(f"✂️ {skipped} entri dilewati (maks. {BATCH_MAX_ENTRIES} per batch).")
+    embed_summary = build_added_summary_embed([label for _, label in resolved[:10]], len(resolved), f"Batch ({len(entries)} entri)", None, '\n'.join(notes) or None)
+    try: await status_message.edit(embed=embed_summary)
+    except discord.HTTPException: await ctx.send(embed=embed_summary)
+    if vc_was_idle and player_state.queue: await play_next(ctx)
+    else: schedule_prefetch(guild_id)
 
 # --- Perintah Lainnya ---
-@bot.command(name='queue', aliases=['q', 'antrian'], help='Tampilkan antrian musik saat ini.')
-async def queue_command(ctx):
-    guild_id = ctx.guild.id; embed = discord.Embed(title="🎶 Antrian Musik Kamu 🎶", color=discord.Color.purple()); embed.set_footer(text=WATERMARK_TEXT)
-    cs_info = current_song.get(guild_id)
-    if cs_info and ctx.voice_client and (ctx.voice_client.is_playing() or ctx.voice_client.is_paused()):
+def format_duration(seconds):
+    minutes, secs = divmod(int(seconds), 60); hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{secs:02d}" if hours else f"{minutes}:{secs:02d}"
+
+def queue_page_count(queue):
+    return max(1, -(-len(queue) // QUEUE_PAGE_SIZE)) if queue else 1
+
+def queue_page_text(player, page):
+    # Dirender sekali per versi antrian; hanya item di halaman ini yang dibaca (akses berindeks O(1) per item)
+    version, pages = player.queue_pages
+    if version != player.queue.version: pages = {}; player.queue_pages = (player.queue.version, pages)
+    text = pages.get(page)
+    if text is None:
+        start = page * QUEUE_PAGE_SIZE
+        lines = [f"`{i+1}.` {queue_item_label(item)[:90]}" + (f" `{format_duration(item.duration)}`" if getattr(item, 'duration', None) else "") for i, item in enumerate(player.queue[start:start + QUEUE_PAGE_SIZE], start)]
+        text = pages[page] = "\n".join(lines)[:1024] or "Kosong."
+    return text
+
+def build_queue_embed(guild, page):
+    guild_id = guild.id; vc = guild.voice_client; embed = discord.Embed(title="🎶 Antrian Musik Kamu 🎶", color=discord.Color.purple()); embed.set_footer(text=WATERMARK_TEXT)
+    cs_info = current_song_info(guild_id); remaining = 0
+    if cs_info and vc and (vc.is_playing() or vc.is_paused()):
         url_link = '#'; match_link = re.search(r'\((.*?)\)', cs_info.get('url_display','')); 
         if match_link: url_link = match_link.group(1)
         desc = f"**[{cs_info['title']}]({url_link})** {cs_info.get('url_display','')}"
@@ -455,14 +2195,50 @@ async def queue_command(ctx):
         details = [f"Dur: {int(cs_info['duration']//60)}:{int(cs_info['duration']%60):02d}" if cs_info.get('duration') else "", f"Oleh: {cs_info['uploader']}" if cs_info.get('uploader') else ""]
         desc += f"\n`{' | '.join(filter(None, details))}`" if any(details) else ""
         embed.add_field(name="🎧 Sedang Diputar:", value=desc, inline=False)
+        source = current_track_source(vc)
+        if source and source.duration: remaining = max(0, source.duration - source.position)
     else: embed.add_field(name="🎧 Sedang Diputar:", value="Tidak ada.", inline=False)
-    q = music_queue.get(guild_id)
+    player = find_player(guild_id); q = player.queue if player else None
     if q:
-        q_text = "\n".join(f"`{i+1}.` {item.get('artist','')} - {item.get('title','Lagu')}".strip(" - ") if isinstance(item, dict) else f"`{i+1}.` {str(item)}" for i, item in enumerate(q[:10]))
-        embed.add_field(name=f"🗒️ Berikutnya ({len(q)} lagu):", value=q_text if q_text else "Kosong.", inline=False)
-        if len(q) > 10: embed.add_field(name="...", value=f"Dan {len(q)-10} lainnya.", inline=False)
+        pages = queue_page_count(q); page = max(0, min(page, pages - 1))
+        embed.add_field(name=f"🗒️ Berikutnya ({len(q)} lagu):", value=queue_page_text(player, page), inline=False)
+        total = f"~{format_duration(q.duration + remaining)}" + (f" (+{q.unknown_durations} lagu tanpa info durasi)" if q.unknown_durations else "")
+        embed.add_field(name="⏱️ Sisa Durasi:", value=total, inline=False)
+        if pages > 1: embed.set_footer(text=f"Halaman {page + 1}/{pages} • {WATERMARK_TEXT}")
     else: embed.add_field(name="🗒️ Berikutnya:", value="Antrian kosong.", inline=False)
-    await ctx.send(embed=embed)
+    return embed
+
+class QueueView(discord.ui.View):
+    def __init__(self, *, timeout=180, guild, page=0):
+        super().__init__(timeout=timeout)
+        self.guild = guild; self.page = page; self.message = None
+        self.update_buttons_state()
+
+    def update_buttons_state(self):
+        pages = queue_page_count(find_queue(self.guild.id)); self.page = max(0, min(self.page, pages - 1))
+        self.prev_button.disabled = self.page == 0
+        self.next_button.disabled = self.page >= pages - 1
+
+    async def _show(self, interaction):
+        self.update_buttons_state()
+        await interaction.response.edit_message(embed=build_queue_embed(self.guild, self.page), view=self)
+
+    @discord.ui.button(label="Sebelumnya", style=discord.ButtonStyle.secondary, emoji="◀️", custom_id="queue_prev")
+    async def prev_button(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.page -= 1; await self._show(interaction)
+
+    @discord.ui.button(label="Berikutnya", style=discord.ButtonStyle.secondary, emoji="▶️", custom_id="queue_next")
+    async def next_button(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.page += 1; await self._show(interaction)
+
+    async def on_timeout(self):
+        if self.message: message_updates.edit(self.message, view=None)
+
+@bot.command(name='queue', aliases=['q', 'antrian'], help='Tampilkan antrian musik (per halaman; pakai tombol ◀️/▶️ atau `queue <halaman>`).')
+async def queue_command(ctx, halaman: int = 1):
+    page = halaman - 1; view = QueueView(guild=ctx.guild, page=page) if queue_page_count(find_queue(ctx.guild.id)) > 1 else None
+    message = await ctx.send(embed=build_queue_embed(ctx.guild, view.page if view else page), view=view)
+    if view: view.message = message
 
 @bot.command(name='skip', aliases=['s', 'lewati'], help='Lewati lagu yang sedang diputar.')
 async def skip(ctx):
@@ -473,11 +2249,11 @@ async def skip(ctx):
     if not ctx.author.voice or ctx.author.voice.channel != vc.channel:
         embed = discord.Embed(description="⚠️ Kamu harus di VC yang sama.", color=discord.Color.orange()); embed.set_footer(text=WATERMARK_TEXT)
         return await ctx.send(embed=embed)
-    skipped_title = current_song.get(ctx.guild.id, {}).get('title', 'Lagu ini')
+    skipped_title = current_song_info(ctx.guild.id).get('title', 'Lagu ini')
     embed = discord.Embed(title="⏭️ Lagu Dilewati", description=f"**{skipped_title}** oleh {ctx.author.mention}.", color=discord.Color.blue()); embed.set_footer(text=WATERMARK_TEXT)
-    # Kirim pesan skip *sebelum* vc.stop() agar tidak ada race condition dengan pesan Now Playing baru dari play_next
-    await ctx.send(embed=embed) 
-    vc.stop()
+    # Antre pesan skip *sebelum* vc.stop() agar terkirim lebih dulu dari pesan Now Playing baru dari play_next
+    message_updates.send(ctx.channel, embed=embed)
+    stop_current(vc)
 
 @bot.command(name='pause', aliases=['jeda'], help='Jeda musik yang sedang diputar.')
 async def pause(ctx):
@@ -486,8 +2262,8 @@ async def pause(ctx):
         vc.pause()
         embed = discord.Embed(description=f"⏸️ Musik dijeda. `{BOT_PREFIX}resume` atau tombol untuk lanjut.", color=discord.Color.blue()); embed.set_footer(text=WATERMARK_TEXT)
         await ctx.send(embed=embed)
-        msg = now_playing_message.get(ctx.guild.id)
-        if msg and isinstance(msg.view, MusicPlayerView): msg.view.update_buttons_state(); await msg.edit(view=msg.view)
+        msg = getattr(find_player(ctx.guild.id), 'now_playing_message', None)
+        if msg and isinstance(msg.view, MusicPlayerView): msg.view.update_buttons_state(); message_updates.edit(msg, view=msg.view)
     else:
         embed = discord.Embed(description="⚠️ Tidak ada musik yg diputar/sudah dijeda.", color=discord.Color.orange()); embed.set_footer(text=WATERMARK_TEXT)
         await ctx.send(embed=embed)
@@ -499,8 +2275,10 @@ async def resume(ctx):
         vc.resume()
         embed = discord.Embed(description="▶️ Musik dilanjutkan!", color=discord.Color.green()); embed.set_footer(text=WATERMARK_TEXT)
         await ctx.send(embed=embed)
-        msg = now_playing_message.get(ctx.guild.id)
-        if msg and isinstance(msg.view, MusicPlayerView): msg.view.update_buttons_state(); await msg.edit(view=msg.view)
+        msg = getattr(find_player(ctx.guild.id), 'now_playing_message', None)
+        if msg and isinstance(msg.view, MusicPlayerView): msg.view.update_buttons_state(); message_updates.edit(msg, view=msg.view)
+    elif vc and not vc.is_playing() and find_queue(ctx.guild.id): # Antrian sempat dijeda karena gagal beruntun
+        await play_next(ctx)
     else:
         embed = discord.Embed(description="⚠️ Tidak ada musik yang dijeda.", color=discord.Color.orange()); embed.set_footer(text=WATERMARK_TEXT)
         await ctx.send(embed=embed)
@@ -513,10 +2291,9 @@ async def stop(ctx):
         return await ctx.send(embed=embed)
     
     guild_id = ctx.guild.id
-    if guild_id in music_queue: music_queue[guild_id].clear()
-    current_song.pop(guild_id, None); song_history.pop(guild_id, None); autoplay_enabled.pop(guild_id, None)
+    released = await teardown_guild(ctx.guild, 'stop')
     
-    msg_np = now_playing_message.pop(guild_id, None)
+    msg_np = released and released.now_playing_message
     if msg_np:
         try:
             await msg_np.edit(content="Pemutaran dihentikan.", embed=None, view=None) 
@@ -526,24 +2303,81 @@ async def stop(ctx):
             print(f"HTTP error saat edit pesan Now Playing (stop command): {e}")
         except Exception as e:
             print(f"Error umum saat edit pesan Now Playing (stop command): {e}")
-
-    if vc.is_playing() or vc.is_paused(): vc.stop()
-    await vc.disconnect()
     
     embed_stop_msg = discord.Embed(description="⏹️ Musik dihentikan, antrian bersih, bot keluar.", color=discord.Color.red()); embed_stop_msg.set_footer(text=WATERMARK_TEXT)
     await ctx.send(embed=embed_stop_msg)
 
 @bot.command(name='clearqueue', aliases=['cq', 'hapusantrian'], help='Bersihkan semua lagu dari antrian.')
 async def clearqueue(ctx):
-    guild_id = ctx.guild.id
-    if music_queue.get(guild_id):
-        music_queue[guild_id].clear()
+    guild_id = ctx.guild.id; player_state = find_player(guild_id)
+    if player_state and (player_state.queue or player_state.imports):
+        cancel_imports(guild_id); player_state.queue.clear(); schedule_prefetch(guild_id)
         embed = discord.Embed(description="🗑️ Antrian musik bersih!", color=discord.Color.blue()); embed.set_footer(text=WATERMARK_TEXT)
         await ctx.send(embed=embed)
     else:
         embed = discord.Embed(description="ℹ️ Antrian musik sudah kosong.", color=discord.Color.light_grey()); embed.set_footer(text=WATERMARK_TEXT)
         await ctx.send(embed=embed)
 
+@bot.command(name='remove', aliases=['rm', 'hapus'], help='Hapus satu lagu dari antrian berdasarkan nomornya.')
+async def remove(ctx, posisi: int):
+    q = find_queue(ctx.guild.id)
+    if not q or not 1 <= posisi <= len(q):
+        embed = discord.Embed(description=f"⚠️ Nomor tidak valid. Lihat `{BOT_PREFIX}queue`.", color=discord.Color.orange()); embed.set_footer(text=WATERMARK_TEXT)
+        return await ctx.send(embed=embed)
+    removed = q.remove_at(posisi - 1); schedule_prefetch(ctx.guild.id)
+    embed = discord.Embed(description=f"🗑️ **{queue_item_label(removed)}** dihapus dari antrian.", color=discord.Color.blue()); embed.set_footer(text=WATERMARK_TEXT)
+    await ctx.send(embed=embed)
+
+@bot.command(name='move', aliases=['mv', 'pindah'], help='Pindahkan lagu di antrian ke posisi lain.')
+async def move(ctx, dari: int, ke: int):
+    q = find_queue(ctx.guild.id)
+    if not q or not 1 <= dari <= len(q) or not 1 <= ke <= len(q):
+        embed = discord.Embed(description=f"⚠️ Nomor tidak valid. Lihat `{BOT_PREFIX}queue`.", color=discord.Color.orange()); embed.set_footer(text=WATERMARK_TEXT)
+        return await ctx.send(embed=embed)
+    moved = q.move(dari - 1, ke - 1); schedule_prefetch(ctx.guild.id)
+    embed = discord.Embed(description=f"↕️ **{queue_item_label(moved)}** dipindah ke posisi `{ke}`.", color=discord.Color.blue()); embed.set_footer(text=WATERMARK_TEXT)
+    await ctx.send(embed=embed)
+
+@bot.command(name='shuffle', aliases=['acak'], help='Acak urutan lagu di antrian.')
+async def shuffle(ctx):
+    q = find_queue(ctx.guild.id)
+    if not q:
+        embed = discord.Embed(description="ℹ️ Antrian musik kosong.", color=discord.Color.light_grey()); embed.set_footer(text=WATERMARK_TEXT)
+        return await ctx.send(embed=embed)
+    q.shuffle(); schedule_prefetch(ctx.guild.id)
+    embed = discord.Embed(description=f"🔀 {len(q)} lagu di antrian diacak!", color=discord.Color.blue()); embed.set_footer(text=WATERMARK_TEXT)
+    await ctx.send(embed=embed)
+
+@bot.command(name='qmem', aliases=['memori'], help='Tampilkan perkiraan memori antrian guild ini.')
+async def qmem(ctx):
+    q = find_queue(ctx.guild.id)
+    guild_bytes = q.memory_usage() if q else 0
+    total_bytes = sum(p.queue.memory_usage() for p in players.values())
+    desc = f"Guild ini: **{guild_bytes/1024:.1f} KiB** ({len(q) if q else 0} lagu"
+    desc += f", ~{guild_bytes/len(q):.0f} B/lagu)" if q else ")"
+    desc += f"\nSemua guild: **{total_bytes/1024:.1f} KiB** ({len(players)} antrian)"
+    embed = discord.Embed(title="🧠 Memori Antrian", description=desc, color=discord.Color.dark_teal()); embed.set_footer(text=WATERMARK_TEXT)
+    await ctx.send(embed=embed)
+
+def format_stage_lines(items):
+    return '\n'.join(f"`{stage}` p50 {hist.quantile(0.5)*1000:.0f}ms · p95 {hist.quantile(0.95)*1000:.0f}ms · n={hist.count}" for stage, hist in items)[:1024] or "Belum ada data"
+
+@bot.command(name='stats', aliases=['metrik'], help='(Admin) Latensi tiap tahap, lag event loop & beban executor.')
+@commands.check_any(commands.is_owner(), commands.has_permissions(administrator=True))
+async def stats_command(ctx):
+    stages = sorted(metrics.stages.items()); gauges = {name: samples for name, _, samples in collect_gauges()}
+    embed = discord.Embed(title="📊 Statistik Bot", color=discord.Color.dark_teal()); embed.set_footer(text=WATERMARK_TEXT)
+    embed.add_field(name="Tahap Hot Path", value=format_stage_lines([i for i in stages if not i[0].startswith('command_')]), inline=False)
+    embed.add_field(name="Perintah", value=format_stage_lines([i for i in stages if i[0].startswith('command_')]), inline=False)
+    embed.add_field(name="Event Loop", value=f"Lag p95 {metrics.loop_lag.quantile(0.95)*1000:.1f}ms · maks {metrics.loop_lag_max*1000:.1f}ms", inline=True)
+    embed.add_field(name="Pemutar", value=f"{len(players)} terdaftar · {sum(gauges['musicbot_players_active'].values())} aktif · {gauges['musicbot_queue_items'][()]} lagu antre", inline=True)
+    embed.add_field(name="Antrian Executor", value=' · '.join(f"{labels[0][1]} {depth}" for labels, depth in gauges['musicbot_executor_queue_depth'].items()), inline=False)
+    updates = message_updates.stats()
+    disk = audio_cache.stats() if audio_cache else None
+    disk_text = f" · cache audio hit {disk['hit_rate']:.0%} ({disk['hits']}/{disk['hits'] + disk['misses']}, {disk['bytes'] / 1024**2:.0f} MiB)" if disk else ""
+    embed.add_field(name="Cache & Pesan", value=f"Resolve hit {resolve_cache.stats()['hit_rate']:.0%}{disk_text} · pemulihan stream {stream_recovery_stats['recovered']}/{stream_recovery_stats['attempts']} · update pesan dihemat {updates['merged'] + updates['in_place']}", inline=False)
+    await ctx.send(embed=embed)
+
 @bot.command(name='ping', help='Cek responsivitas bot.')
 async def ping(ctx):
     latency = round(bot.latency * 1000)
@@ -565,11 +2399,62 @@ async def on_command_error(ctx, error):
     else: embed.description = f"Error tidak dikenal: `{error}`"; print(f'Error tidak dikenal: {error}')
     await ctx.send(embed=embed)
 
+# --- Mode Cluster (beberapa proses, masing-masing memegang sebagian shard) ---
+CLUSTER_START_DELAY = float(os.getenv('CLUSTER_START_DELAY', '5')) # Detik per shard antar start proses (batas IDENTIFY Discord)
+CLUSTER_RESTART_MAX_DELAY = float(os.getenv('CLUSTER_RESTART_MAX_DELAY', '300')) # Batas atas backoff restart proses cluster yang crash
+EXIT_LOGIN_FAILURE = 78 # Token ditolak Discord: percuma dijalankan ulang
+
+def fetch_recommended_shard_count(token):
+    request = urllib.request.Request('https://discord.com/api/v10/gateway/bot', headers={'Authorization': f'Bot {token}', 'User-Agent': 'DiscordBot (ip-music, 1.0)'})
+    with urllib.request.urlopen(request, timeout=15) as response: return json.load(response)['shards']
+
+def run_cluster(process_count):
+    shard_count = SHARD_COUNT or fetch_recommended_shard_count(TOKEN)
+    process_count = max(1, min(process_count, shard_count))
+    shard_groups = [list(range(i, shard_count, process_count)) for i in range(process_count)]
+    print(f"Cluster: {shard_count} shard dibagi ke {process_count} proses.")
+
+    def spawn(cluster_id):
+        env = dict(os.environ, SHARD_MODE='auto', SHARD_COUNT=str(shard_count), SHARD_IDS=','.join(map(str, shard_groups[cluster_id])), CLUSTER_ID=str(cluster_id), CLUSTER_PROCESSES='1')
+        print(f"Cluster #{cluster_id}: shard {env['SHARD_IDS']}")
+        return subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env)
+
+    def shutdown(signum, frame): raise SystemExit(0)
+    signal.signal(signal.SIGTERM, shutdown)
+    children = {}; started_at = {}; crashes = {}; restart_at = {}
+    try:
+        for cluster_id in range(process_count):
+            children[cluster_id] = spawn(cluster_id); started_at[cluster_id] = time.monotonic()
+            if cluster_id < process_count - 1: time.sleep(CLUSTER_START_DELAY * len(shard_groups[cluster_id]))
+        while children or restart_at: # Supervisor: hanya proses yang crash dijalankan ulang, dengan backoff eksponensial
+            time.sleep(1); now = time.monotonic()
+            for cluster_id, child in list(children.items()):
+                code = child.poll()
+                if code is None: continue
+                del children[cluster_id]
+                if code == EXIT_LOGIN_FAILURE: print(f"Cluster #{cluster_id}: login ditolak Discord, semua cluster dihentikan."); raise SystemExit(1)
+                if code == 0: print(f"Cluster #{cluster_id} selesai normal, tidak dijalankan ulang."); continue
+                if now - started_at[cluster_id] > CLUSTER_RESTART_MAX_DELAY: crashes[cluster_id] = 0 # Sempat berjalan stabil: backoff mulai dari awal
+                delay = min(CLUSTER_RESTART_MAX_DELAY, 5 * 2 ** crashes.get(cluster_id, 0)); crashes[cluster_id] = crashes.get(cluster_id, 0) + 1
+                restart_at[cluster_id] = now + delay
+                print(f"Cluster #{cluster_id} berhenti (kode {code}), dijalankan ulang dalam {delay:.0f} detik...")
+            for cluster_id, when in list(restart_at.items()):
+                if now >= when: del restart_at[cluster_id]; children[cluster_id] = spawn(cluster_id); started_at[cluster_id] = now
+    except (KeyboardInterrupt, SystemExit): pass
+    finally:
+        for child in children.values():
+            if child.poll() is None: child.terminate()
+        for child in children.values():
+            try: child.wait(timeout=15)
+            except subprocess.TimeoutExpired: child.kill()
+
 # --- Menjalankan Bot ---
 if __name__ == "__main__":
+    startup_mark = record_startup_phase('inisialisasi modul', startup_mark)
     if not TOKEN: print("PENTING: DISCORD_BOT_TOKEN belum diisi di .env")
     # Cek Spotify opsional karena bot bisa jalan tanpa itu (meski fitur spotify mati)
+    elif CLUSTER_PROCESSES > 1 and not SHARD_IDS: run_cluster(CLUSTER_PROCESSES)
     else:
         try: bot.run(TOKEN)
-        except discord.errors.LoginFailure: print("GAGAL LOGIN DISCORD: Token bot tidak valid.")
-        except Exception as e: print(f"Error fatal saat menjalankan bot: {e}")
+        except discord.errors.LoginFailure: print("GAGAL LOGIN DISCORD: Token bot tidak valid."); sys.exit(EXIT_LOGIN_FAILURE)
+        except Exception as e: print(f"Error fatal saat menjalankan bot: {e}"); sys.exit(1)